@@ -1,5 +1,10 @@
 import os
 
+# Optional per-account keys:
+#   db_backend: 'dynamodb' (default) or 'sqlite' for a local embedded database
+#   db_path:    SQLite file used by the sqlite backend
+#   db_sync:    True to write sqlite changes through to DynamoDB as well
+#   logo_overlay: True to stamp logos/<logo_filename> on locally composited maps
 creds = {
         'florida_storms': {
             'db_table_env_var': 'DYNAMODB_TABLE_FLORIDA',
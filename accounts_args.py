@@ -2,11 +2,24 @@ import argparse
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-a', '--account', help='Twitter account name')
-args = parser.parse_args()
+parser.add_argument('--accounts', nargs='+', help='Twitter account names to run together in one pass')
+parser.add_argument('-w', '--workers', type=int, default=1, help='Number of processes rendering alert maps')
+parser.add_argument('--asyncio', action='store_true', help='Run the alert pipeline with asyncio')
+# Ignore unknown arguments so entry points like daemon.py can add their own
+args, _ = parser.parse_known_args()
 
 def account_info():
     if args.account:
         return args.account
     else:
         print('Specify an -a or --account argument')
-        exit()
\ No newline at end of file
+        exit()
+
+def account_list():
+    return args.accounts
+
+def render_workers():
+    return max(1, args.workers)
+
+def use_asyncio():
+    return args.asyncio
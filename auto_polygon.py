@@ -1,85 +1,24 @@
-import itertools
-
 from matplotlib.figure import Figure
-from metpy.plots import USCOUNTIES
 import geopandas
 from cartopy import crs as ccrs
-from cartopy.io.img_tiles import GoogleTiles
-import cartopy.feature as cfeature
 from shapely.geometry import shape
-import requests
-
-cat_gdf = geopandas.read_file('z_30mr21/z_30mr21.shp')
-ugc_county = geopandas.read_file('c_10nv20/c_10nv20.shp')
-
-def is_ugc_county(ugcs):
-    '''Determines whether alert type is UGC county or UGC zone'''
-
-    return True if ugcs[0][2] == 'C' else False
 
-def ugc_zone_geography(ugcs):
-    '''Returns latitudes and longitudes from UGC zone-based alerts'''
+from geometry_cache import load_ugc_index
+from geometry_lod import LOD_LEVELS, lod_level
+from radar_frame import add_radar
+from image_encoder import canvas_rgba, encode_rgb, image_filename
+from basemap import FIGSIZE, DPI, quantize_extent, setup_axes, add_tiles, add_borders, get_basemap_layers, add_basemap
 
-    counties = [ugc.replace('Z', '') for ugc in ugcs]
+ugc_index = None
 
-    latitudes = []
-    longitudes = []
-    geometries = []
-    
-    for ugc in counties:
-        latitude = (cat_gdf[cat_gdf['STATE_ZONE'] == ugc]['LAT']).tolist()
-        longitude = (cat_gdf[cat_gdf['STATE_ZONE'] == ugc]['LON']).tolist()
-        geometry = (cat_gdf[cat_gdf['STATE_ZONE'] == ugc]['geometry']).tolist()
-        latitudes.append(latitude)
-        longitudes.append(longitude)
-        geometries.append(geometry)
-        
-    flatten = itertools.chain.from_iterable
-    latitudes = list(flatten(latitudes))
-    longitudes = list(flatten(longitudes))
-
-    return latitudes, longitudes, geometries
-
-def ugc_county_geography(ugcs):
-    '''
-    Returns latitudes and longitudes from UGC county-based alerts
+def get_ugc_index():
+    '''Loads the UGC index the first time an alert needs it'''
+    global ugc_index
 
-    The alert contains a UGC county-based code (i.e. FLC025)
-    Thus, the final three digits are stored in the 'counties' variable and
-    the first two in the 'state' variable
+    if ugc_index is None:
+        ugc_index = load_ugc_index()
 
-    The FIPS code is a 5-digit number. The first two digits are the U.S. state
-    and the second three digits are the county. 
-    
-    Thus, taking the FIPS code modulo 1000 and checking to see if it matches
-    the final three digits from the UGC county-based code from the weather alert
-    will tell you for which counties the weather alert covers.
-    '''
-    counties = [int(ugc[-3:]) for ugc in ugcs]
-    state = [ugc[0:2] for ugc in ugcs]
-
-    latitudes = []
-    longitudes = []
-    geometries = []
-    
-    for idx, ugc in enumerate(counties):
-        latitude = ugc_county.loc[(
-            ugc_county['STATE'] == state[idx]) & (
-            ugc_county['FIPS'].astype(int) % 1000 == ugc)]['LAT'].tolist()
-        longitude = ugc_county.loc[(ugc_county['STATE'] == state[idx]) & (
-            ugc_county['FIPS'].astype(int) % 1000 == ugc)]['LON'].tolist()
-        geometry = ugc_county.loc[(
-            ugc_county['STATE'] == state[idx]) & (
-            ugc_county['FIPS'].astype(int) % 1000 == ugc)]['geometry']
-        latitudes.append(latitude)
-        longitudes.append(longitude)
-        geometries.append(geometry)
-        
-    flatten = itertools.chain.from_iterable
-    latitudes = list(flatten(latitudes))
-    longitudes = list(flatten(longitudes))
-
-    return latitudes, longitudes, geometries
+    return ugc_index
 
 def convert_geojson_to_geopandas_df(alert_geojson):
     '''Returns map bounds for polygon-based NWS alerts'''
@@ -101,28 +40,38 @@ def convert_geojson_to_geopandas_df(alert_geojson):
     }
 
 def calculate_ugc_geography(alert):
-    ugcs = alert['properties']['geocode']['UGC']
+    '''
+    Returns map bounds for UGC-based NWS alerts. The bounds come from the
+    UGC centroids, so geometries are only loaded at the detail the map needs.
+    '''
+    index = get_ugc_index()
+    ugcs = [ugc for ugc in alert['properties']['geocode']['UGC'] if ugc in index]
+    latitudes = [latitude for ugc in ugcs for latitude in index.centroids(ugc)[0]]
+    longitudes = [longitude for ugc in ugcs for longitude in index.centroids(ugc)[1]]
 
-    if is_ugc_county(ugcs):
-        latitudes, longitudes, geometries = ugc_county_geography(ugcs)
-    else:
-        latitudes, longitudes, geometries = ugc_zone_geography(ugcs)
-    
-    return {
+    alert_map_info = {
         'west_bound': min(longitudes),
         'south_bound': min(latitudes),
         'east_bound': max(longitudes),
-        'north_bound': max(latitudes),
-        'polygon': geometries
+        'north_bound': max(latitudes)
     }
+    alert_map_info['polygon'] = [index.geometries(ugc, lod_level(map_extent(alert_map_info))) for ugc in ugcs]
 
-def get_radar_timestamp():
-    f = requests.get('https://mesonet.agron.iastate.edu/data/gis/images/4326/USCOMP/n0q_0.json').json()
-    validDATE = f['meta']['valid']
-    return validDATE
+    return alert_map_info
 
-def create_map(alert):
-    ''' Create the alert map'''
+def map_extent(alert_map_info):
+    '''Returns the [west, east, south, north] map extent around the alert'''
+    return [alert_map_info['west_bound'] - 0.5, alert_map_info['east_bound'] + 0.5,
+            alert_map_info['south_bound'] - 0.5, alert_map_info['north_bound'] + 0.6]
+
+def draw_map(alert, layered=True):
+    '''
+    Draws the alert map and returns the figure
+
+    In layered mode the tiles and borders come from the pre-rendered basemap
+    cache for the alert's quantized extent and only the radar, alert polygons
+    and title are drawn per alert.
+    '''
 
     alert_map_info = (
         convert_geojson_to_geopandas_df(alert) if alert['geometry'] 
@@ -145,28 +94,28 @@ def create_map(alert):
                     'Rip Current Statement': '#40E0D0',
                     'Red Flag Warning': '#FF1493'}
 
-    google_tiles = GoogleTiles()
     data_crs = ccrs.PlateCarree()
 
-    # Setup matplotlib figure
-    fig = Figure(figsize=(1280/72, 720/72))
-    ax = fig.add_axes([0, 0, 1, 1], projection=data_crs)
-    ax.add_image(google_tiles, 8)
-    ax.set_extent([alert_map_info['west_bound'] - 0.5, alert_map_info['east_bound'] + 0.5, 
-                   alert_map_info['south_bound'] - 0.5, alert_map_info['north_bound'] + 0.6], 
-                   data_crs)
-    ax.set_adjustable('datalim')
+    # Drop polygon detail finer than a pixel at this map's scale
+    level = lod_level(map_extent(alert_map_info))
+    if alert['geometry']:
+        alert_map_info['polygon'] = alert_map_info['polygon'].simplify(
+            LOD_LEVELS[level][1], preserve_topology=True)
 
-    # Setup borders (states, countries, coastlines, etc)
-    ax.add_feature(USCOUNTIES.with_scale('20m'), edgecolor='gray', zorder=5, linewidth=1.2)
-    ax.add_feature(cfeature.STATES.with_scale('10m'), linewidth=3, zorder=5)
+    # Setup matplotlib figure with the tiles and borders (states, countries, coastlines, etc)
+    fig = Figure(figsize=FIGSIZE, dpi=DPI)
+
+    if layered:
+        extent = quantize_extent(map_extent(alert_map_info))
+        ax = setup_axes(fig, extent)
+        add_basemap(ax, get_basemap_layers(extent))
+    else:
+        ax = setup_axes(fig, map_extent(alert_map_info))
+        add_tiles(ax)
+        add_borders(ax, level)
 
     # Add radar
-    ax.add_wms(
-        wms='https://mesonet.agron.iastate.edu/cgi-bin/wms/nexrad/n0q-t.cgi?',
-        layers='nexrad-n0q-wmst',
-        wms_kwargs={'transparent':True, 'time': get_radar_timestamp()}, 
-        zorder=4, alpha=0.4)
+    add_radar(ax)
 
     # Plot alerts on the map
     for key in warning_cmap.keys():
@@ -189,4 +138,32 @@ def create_map(alert):
                  fontweight='bold', fontname='Arial', y=0.96, x=0.03, zorder=11,
                  bbox={'facecolor': '#0c3245', 'alpha': 1.0, 'edgecolor': 'none', 'boxstyle':'square,pad=0.2'})
     
-    fig.savefig('alert_visual.png', dpi=72)
\ No newline at end of file
+    return fig
+
+def render_map_variants(alert, overlays, layered=True, image_format=None):
+    '''
+    Draws the alert map once and encodes it once per overlay. An overlay is
+    None for the plain map or an (event, logo_filename) pair that compositor
+    blends onto the canvas pixels before encoding. Returns image bytes
+    (IMAGE_FORMAT by default) by overlay.
+    '''
+    pixels = canvas_rgba(draw_map(alert, layered))
+    images = {}
+
+    for overlay in overlays:
+        if overlay is None:
+            images[overlay] = encode_rgb(pixels[..., :3], image_format)
+        else:
+            from compositor import composite
+            images[overlay] = encode_rgb(composite(pixels, *overlay), image_format)
+
+    return images
+
+def render_map(alert, layered=True, image_format=None):
+    '''Renders the alert map into image bytes (IMAGE_FORMAT by default) without touching disk'''
+    return render_map_variants(alert, [None], layered, image_format)[None]
+
+def create_map(alert, layered=True, filename=None, image_format=None):
+    ''' Create the alert map, named alert_visual with the format's extension by default'''
+    with open(filename or image_filename(image_format=image_format), 'wb') as f:
+        f.write(render_map(alert, layered, image_format))
\ No newline at end of file
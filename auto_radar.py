@@ -1,19 +1,19 @@
 from datetime import datetime, timedelta
 from random import random
-from siphon.catalog import TDSCatalog
-import cartopy.crs as ccrs
-import xarray as xr
-import numpy as np
-import metpy
-
-from social import Twitter
-from db import Database
+
+import metrics
+from radar_regions import RegionEngine
+from radar_scan import load_scan, is_scan_processed, mark_scan_processed, scan_key
+from storm_cells import process_scan_cells, cells_in_windows
+from radar_zones import evaluate_ugc_areas
 from helpers import is_data_new_enough, utc_to_iso8601, iso8601_to_utc, datetime64_to_datetime, seconds_to_mins, current_day_time
 
-radar_database = Database('DYNAMODB_TABLE_RADAR')
 #tweet = Twitter('ray_hawthorne')
 
 def get_catalog():
+    from siphon.catalog import TDSCatalog
+    import metpy  # registers the .metpy accessor on xarray objects
+
     radar = TDSCatalog('https://thredds.ucar.edu/thredds/catalog/grib/nexrad/composite/unidata/latest.xml')
     data = radar.datasets[0].remote_access(use_xarray=True)
     return data.metpy.parse_cf()
@@ -21,28 +21,28 @@ def get_catalog():
 def get_projection_info(ds):
     return ds.metpy.cartopy_crs
 
-def convert_latlon_to_xy(lat, lon):
-    plot_proj = ds.metpy.cartopy_crs
-    location = get_projection_info(ds).transform_point(lon, lat, ccrs.PlateCarree())
-    x, y = location
-    return x, y
-
-def get_grid_values(bounding_box: []):
-    nw_lat, nw_lon, se_lat, se_lon = bounding_box
-    x_UL, y_UL = convert_latlon_to_xy(nw_lat, nw_lon)
-    x_LR, y_LR = convert_latlon_to_xy(se_lat, se_lon)
+@metrics.timed('radar_catalog')
+def get_reflectivity():
+    '''Opens the latest composite reflectivity (metadata only until values are read)'''
+    return get_catalog()['Base_reflectivity_surface_layer'].squeeze()
 
-    data_array = ds.metpy.sel(x=slice(x_UL, x_LR), y=slice(y_LR, y_UL))
-    return data_array.values
+def evaluate_areas(scan, crs, engine, threshold, cells):
+    '''
+    Evaluates every area against the locally cached regional scan and counts
+    the storm cells overlapping each area
+    '''
+    windows = engine.get_windows(scan['x'], scan['y'], crs)
+    results = engine.evaluate(scan['values'], windows, threshold)
+    cell_counts = cells_in_windows(cells, windows).sum(axis=1)
 
-def is_threshold_reached(array, threshold):
-    return np.any(array[:, :] >= threshold)
+    return [dict(result, cell_count=int(cell_counts[idx])) for idx, result in enumerate(results)]
 
-def is_eligible_for_tweeting(radar_metadata: []):
+def is_eligible_for_tweeting(radar_metadata: [], time_script_ran):
     time_deltas = [(iso8601_to_utc(time_script_ran) - iso8601_to_utc(data['data_time'])).seconds for data in radar_metadata]
     time_deltas = [seconds_to_mins(delta) for delta in time_deltas]
     data_with_timedeltas = [dict(data, timedelta=time_deltas[idx]) for idx, data in enumerate(radar_metadata)]
-    eligible_radars = [location for location in data_with_timedeltas if location['timedelta'] >= 60 and location['threshold_reached']]
+    eligible_radars = [location for location in data_with_timedeltas if location['timedelta'] >= 60 and location['threshold_reached']
+                       and location.get('cell_count', 1) > 0]
     
     # Add time threshold reached to DB
 
@@ -53,8 +53,18 @@ def tweet_message(eligible_data: []):
         [tweet.tweet_image_from_web(info['img_url'], f"[{current_day_time()}]: Radar update in the {info['region']} area") for info in eligible_data]
     
 def main():
+    from db import open_database
+
+    radar_database = open_database('DYNAMODB_TABLE_RADAR')
+    ds = get_reflectivity()
+    time_script_ran = utc_to_iso8601(datetime.utcnow())
+
+    # Nothing to do if this scan was already handled by a previous run
+    if is_scan_processed(scan_key(ds)):
+        print(f'Radar scan {scan_key(ds)} already processed')
+        return
+
     area_names = [area['area'] for area in areas]
-    coords = [area['coords'] for area in areas]
     url = [area['url'] for area in areas]
     ids = [area['id'] for area in areas]
 
@@ -63,26 +73,43 @@ def main():
 
     # Check to see if radar data from server is new enough to process
     if is_data_new_enough(ds.time.values, 30):
-        for idx, place_of_interest in enumerate(coords):
-            raw_data = get_grid_values(place_of_interest)
-            threshold_reached = bool(is_threshold_reached(raw_data, trigger))
+        crs = get_projection_info(ds)
+        with metrics.span('radar_load'):
+            scan = load_scan(ds, crs)
+        with metrics.span('storm_cells'):
+            cells = process_scan_cells(scan, ds.time.values, trigger, crs)
+        with metrics.span('radar_regions'):
+            results = evaluate_areas(scan, crs, region_engine, trigger, cells)
+        print(f'{len(cells["x"])} storm cells identified')
+        metrics.count('storm_cells', len(cells['x']))
+
+        with metrics.span('radar_zones'):
+            ugc_statistics = evaluate_ugc_areas(scan, crs, trigger)
+        triggered_ugcs = sorted(code for code, stats in ugc_statistics.items() if stats['threshold_reached'])
+        print(f'[AUTOMATION]: {trigger} dBZ radar echo detected in counties/zones: {triggered_ugcs}' 
+        if triggered_ugcs else 'Trigger not reached in any county or zone.')
+
+        for idx, result in enumerate(results):
+            print(f'[AUTOMATION]: {trigger} dBZ radar echo detected in the {area_names[idx]} area' 
+            if result['threshold_reached'] else 'Trigger not reached.')
 
-            # If threshold reached, save data to database
-            radar_database.put(
+        # Save every area's result to the database
+        with metrics.span('db_put'):
+            radar_database.put_many([
                 {'id': ids[idx], 
                 'timestamp': time_script_ran,
                 'data_time': datetime64_to_datetime(ds.time.values),
                 'region': area_names[idx], 
                 'img_url': url[idx],
-                'threshold_reached': threshold_reached}) #if threshold_reached else None   
-
-            print(f'[AUTOMATION]: {trigger} dBZ radar echo detected in the {area_names[idx]} area' 
-            if threshold_reached else 'Trigger not reached.')
+                'threshold_reached': result['threshold_reached'],
+                'cell_count': result['cell_count']} for idx, result in enumerate(results)])
         
-        is_eligible = is_eligible_for_tweeting(radar_database.get_all())
+        is_eligible = is_eligible_for_tweeting(radar_database.get_all(), time_script_ran)
         print(is_eligible)
         #tweet_message(is_eligible)
 
+        mark_scan_processed(scan['key'])
+
 # Areas of interest
 areas = [
     {'id': '01',
@@ -135,8 +162,8 @@ areas = [
      'url': 'https://pbsweather.org/maps/FL/radars/WLRN-Radar.jpg'},
 ]
 
-ds = get_catalog()['Base_reflectivity_surface_layer'].squeeze()
-time_script_ran = utc_to_iso8601(datetime.utcnow())
+region_engine = RegionEngine(areas)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    with metrics.run('radar'):
+        main()
\ No newline at end of file
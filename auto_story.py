@@ -1,14 +1,24 @@
 import os
 
-from social import Twitter
-from db import Database
+import metrics
 from accounts_args import account_info 
 from accounts import creds
 from helpers import api_get
 
-dynamo = Database(creds[account_info()]['db_table_env_var_stories'])
-tweet = Twitter(account_info())
+databases = {}
 
+def get_database(account):
+    '''Returns the account's story table, creating it on first use'''
+    if account not in databases:
+        from db import open_database
+        databases[account] = open_database(creds[account]['db_table_env_var_stories'], creds[account])
+    return databases[account]
+
+def get_twitter(account):
+    from poster import get_client
+    return get_client(account)
+
+@metrics.timed('npr_fetch')
 def get_latest_story(desired_tag):
     data = api_get(f"https://api.npr.org/query?orgId=4780105&fields=title,parent,teaser,image&dateType=story&output=JSON&apiKey={os.environ['NPR_API_KEY']}")
     tag = data['list']['story'][0]['parent'][0]['title']['$text'].upper()
@@ -27,8 +37,10 @@ def twitter_message(story):
     message = f"{get_teaser(story)} More >> {get_story_link(story)}"
     return message
 
-def send_tweet_story(story):
-    tweet.tweet_image_from_web(get_story_graphic(story), twitter_message(story))
+def send_tweet_story(story, account):
+    with metrics.span('twitter_post'):
+        get_twitter(account).tweet_image_from_web(get_story_graphic(story), twitter_message(story))
+    metrics.count('posts')
 
 def is_story_already_tweeted(latest_story, existing_story):
     return True if existing_story[0]['id'] == latest_story['id'] else None
@@ -36,32 +48,35 @@ def is_story_already_tweeted(latest_story, existing_story):
 def is_database_empty(existing_story):
     return True if len(existing_story) == 0 else False
 
-def store_story_metadata_in_db(story):
-    dynamo.put(
+def store_story_metadata_in_db(story, account):
+    get_database(account).put(
         {'id': story['id'], 
         'title': story['title']['$text'], 
         'tag': story['parent'][0]['title']['$text']})
 
-def delete_old_story(latest_story, existing_story):
+def delete_old_story(latest_story, existing_story, account):
     if latest_story['id'] != existing_story[0]['id']: 
-        dynamo.delete(existing_story[0]['id'])
+        get_database(account).delete(existing_story[0]['id'])
 
-def main():
+def main(account=None):
+    account = account or account_info()
     latest_story = get_latest_story('FPREN')
-    existing_story = dynamo.get_all()
+    with metrics.span('db_scan'):
+        existing_story = get_database(account).get_all()
 
     if is_database_empty(existing_story):
-        store_story_metadata_in_db(latest_story)
-        send_tweet_story(latest_story)
+        store_story_metadata_in_db(latest_story, account)
+        send_tweet_story(latest_story, account)
         return
 
     if not is_story_already_tweeted(latest_story, existing_story):
-        delete_old_story(latest_story, existing_story)
-        store_story_metadata_in_db(latest_story)
-        send_tweet_story(latest_story)
+        delete_old_story(latest_story, existing_story, account)
+        store_story_metadata_in_db(latest_story, account)
+        send_tweet_story(latest_story, account)
     
     return
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    with metrics.run('story'):
+        main()
\ No newline at end of file
@@ -1,18 +1,36 @@
 from decimal import Decimal
+import asyncio
 import json
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 
-from social import Twitter
-from db import Database
-from accounts_args import account_info 
+import metrics
+from accounts_args import account_info, account_list, render_workers, use_asyncio
 from accounts import creds
-from helpers import convert_to_local, is_alert_active, api_get
-from auto_polygon import create_map
-from banner import upload_and_transform, upload_and_no_transform, cleanup
+from helpers import convert_to_local, is_alert_active, api_get, api_get_if_modified
+from http_client import confirm_validators, forget_validators
+from banner import upload_and_transform, cleanup
+
+# The plotting stack (auto_polygon), boto3 (db) and tweepy (social) are
+# imported on first use so runs without new alerts never load them
+
+databases = {}
+
+ALERTS_OF_INTEREST = [
+    'Tornado Warning', 'Severe Thunderstorm Warning', 'Flash Flood Warning',
+    'Tornado Watch', 'Severe Thunderstorm Watch']
+
+# Maximum concurrent calls per service in the asyncio pipeline. Accounts can
+# override these with a 'concurrency' dict in accounts.creds
+CONCURRENCY_LIMITS = {'db': 10, 'upload': 4, 'twitter': 1}
+
+def get_database(account):
+    '''Returns the account's alert table, creating it on first use'''
+    if account not in databases:
+        from db import open_database
+        databases[account] = open_database(creds[account]['db_table_env_var'], creds[account])
+    return databases[account]
 
-dynamo = Database(creds[account_info()]['db_table_env_var'])
-tweet = Twitter(account_info())
-    
 def prepare_alert_message(alert):
     _id = alert['properties']['id']
     hyperlink = f'https://alerts-v2.weather.gov/#/?id={_id}'
@@ -40,75 +58,370 @@ def prepare_alert_message(alert):
     
     return message
     
-def get_alerts(endpoint):
-    data = api_get(f"https://api.weather.gov/alerts/active?status=actual&message_type=alert&{endpoint}")
+def alerts_url(endpoint):
+    return f"https://api.weather.gov/alerts/active?status=actual&message_type=alert&{endpoint}"
+
+def get_alerts(endpoint, key=None):
+    '''
+    Returns active alerts for the endpoint. With a key the request is
+    conditional and None is returned if nothing changed since the key's
+    last confirmed fetch.
+    '''
+    with metrics.span('nws_fetch'):
+        data = api_get_if_modified(alerts_url(endpoint), key) if key else api_get(alerts_url(endpoint))
+    if data is None:
+        metrics.count('nws_not_modified')
+        return None
+
     alerts = data['features']
+    metrics.count('alerts_fetched', len(alerts))
     return alerts
 
-def aggregate_message_and_media():
-    alerts_of_interest = [
-        'Tornado Warning', 'Severe Thunderstorm Warning', 'Flash Flood Warning',
-        'Tornado Watch', 'Severe Thunderstorm Watch']
+def overlay_key(alert, account):
+    '''
+    Returns the (event, logo_filename) overlay blended into the account's map
+    while it is rendered, or None for a plain map (no overlays, or overlays
+    applied by Cloudinary)
+    '''
+    config = creds[account]
+    if not config['overlays']:
+        return None
+
+    from compositor import can_composite
+    event = alert['properties']['event']
+    if not can_composite(event):
+        return None
+
+    return event, config.get('logo_filename') if config.get('logo_overlay') else None
+
+def render_alert_maps(alerts, workers=1, overlays=None):
+    '''
+    Renders each alert map once and encodes it once per overlay in the
+    matching list of overlays (default: just the plain map), using a pool of
+    worker processes when workers > 1. Returns dictionaries of image bytes by
+    overlay in alert order, with None in place of any map that failed to render.
+    '''
+    from auto_polygon import render_map_variants
+
+    overlays = overlays or [[None]] * len(alerts)
+
+    with metrics.span('render_maps'):
+        if workers > 1 and len(alerts) > 1:
+            with ProcessPoolExecutor(max_workers=min(workers, len(alerts))) as pool:
+                futures = [pool.submit(render_map_variants, alert, keys) for alert, keys in zip(alerts, overlays)]
+                results = []
+                for alert, future in zip(alerts, futures):
+                    error = future.exception()
+                    results.append((alert, error, None if error else future.result()))
+        else:
+            results = []
+            for alert, keys in zip(alerts, overlays):
+                try:
+                    with metrics.span('create_map'):
+                        results.append((alert, None, render_map_variants(alert, keys)))
+                except Exception as e:
+                    results.append((alert, e, None))
+
+    images = []
+    for alert, error, image in results:
+        if error:
+            print(f"Unable to render map for {alert['properties']['id']}: {error}")
+            metrics.count('map_failures')
+        images.append(image)
+
+    return images
 
-    tweetable_alerts = []
-    new_alerts = retrieve_new_alerts()
+def alert_media(alert, image, overlay, account):
+    '''
+    Returns the message media for a map rendered with the given overlay. Maps
+    with a local overlay, or without overlays, are tweeted directly. Overlay
+    accounts without a local overlay upload the plain map to Cloudinary and
+    tweet the transformed URL.
+    '''
+    if image is None:
+        return {'media': None, 'image': None}
+
+    if overlay is None and creds[account]['overlays']:
+        return {'media': upload_and_transform(alert['properties']['event'], image), 'image': None}
+
+    return {'media': None, 'image': image}
+
+def prepare_alert_media(alert, images, account=None):
+    '''Returns the message media, picking the account's overlay from the images rendered by render_alert_maps'''
+    account = account or account_info()
+    overlay = overlay_key(alert, account)
+    return alert_media(alert, images.get(overlay) if images else None, overlay, account)
+
+def issued_at(alert):
+    return datetime.strptime(alert['properties']['sent'], "%Y-%m-%dT%H:%M:%S%z")
+
+def alert_message(alert, media):
+    '''Returns the message to post for an alert, remembering when the alert was issued'''
+    return {'message': prepare_alert_message(alert), 'id': alert['properties']['id'],
+            'event': alert['properties']['event'], 'sent': alert['properties']['sent'], **media}
+
+def find_tweetable_alerts(new_alerts):
+    '''Returns the alerts worth tweeting, in the order they were issued'''
+    tweetable_alerts = [new_alert for new_alert in new_alerts if new_alert['properties']['event'] in ALERTS_OF_INTEREST]
+    return sorted(tweetable_alerts, key=issued_at)
+
+def aggregate_message_and_media(account=None):
+    account = account or account_info()
+    new_alerts = retrieve_new_alerts(account)
     new_messages = []
 
-    tweetable_alerts = [new_alert for new_alert in new_alerts if new_alert['properties']['event'] in alerts_of_interest]
+    tweetable_alerts = find_tweetable_alerts(new_alerts)
     
     if tweetable_alerts:
-        for tweetable_alert in tweetable_alerts:
-            create_map(tweetable_alert)
-            img_url = (
-                upload_and_transform(tweetable_alert['properties']['event']) if creds[account_info()]['overlays'] 
-                else upload_and_no_transform())
-            new_messages.append({'message': prepare_alert_message(tweetable_alert), 'media': img_url})
+        overlays = [[overlay_key(tweetable_alert, account)] for tweetable_alert in tweetable_alerts]
+        images = render_alert_maps(tweetable_alerts, render_workers(), overlays)
+        for tweetable_alert, alert_images in zip(tweetable_alerts, images):
+            new_messages.append(alert_message(tweetable_alert, prepare_alert_media(tweetable_alert, alert_images, account)))
             
     return new_messages
       
-def retrieve_new_alerts():    
-    # Make API call to retrieve alerts    
-    alerts = get_alerts(creds[account_info()]['api_endpoint'])
-
-    # Retrieve active alerts from the database
-    active_alerts = dynamo.get_all()
+def alert_record(alert, claimed_by=None):
+    '''Returns the database item tracking an alert, marked with the runner claiming it if given'''
+    return json.loads(json.dumps({
+        'id': alert['properties']['id'],
+        'event': alert['properties']['event'],
+        'areaDesc': alert['properties']['areaDesc'],
+        'expires': alert['properties']['expires'],
+        **({'claimed_by': claimed_by} if claimed_by else {})
+    }), parse_float=Decimal)
 
-    # Remove expired alerts from database
-    expired_alerts = list(filter(lambda alert: is_alert_active(alert['expires']) == False, active_alerts))
-    [dynamo.delete(expired_alert['id']) for expired_alert in expired_alerts]
+def find_expired_alerts(active_alerts):
+    return list(filter(lambda alert: is_alert_active(alert['expires']) == False, active_alerts))
 
-    # Store any new alerts since the script last ran
-    new_alerts = []
-    
-    # Add new alerts to active_alerts list if they don't already exist and
-    # double-check to make sure any of the new alerts aren't already expired
-    for alert in alerts:
-        if (alert['properties']['id'] not in list(map(lambda alert: alert['id'], active_alerts))
-        and is_alert_active(alert['properties']['expires'])):
-            dynamo.put(json.loads(json.dumps({
-                'id': alert['properties']['id'],
-                'event': alert['properties']['event'],
-                'areaDesc': alert['properties']['areaDesc'],
-                'expires': alert['properties']['expires']
-            }), parse_float=Decimal))
-            new_alerts.append(alert)
+def find_new_alerts(alerts, active_alerts):
+    '''
+    Returns alerts that aren't in the database yet, double-checking to make
+    sure none of them are already expired
+    '''
+    active_ids = set(map(lambda alert: alert['id'], active_alerts))
+    return [alert for alert in alerts
+            if alert['properties']['id'] not in active_ids and is_alert_active(alert['properties']['expires'])]
 
+def print_alert_summary(new_alerts, active_alerts):
     print('----')
     print('New Alerts: ', list(map(lambda new_alert: new_alert['properties']['id'], new_alerts)))
     print('Active Alerts: ', list(map(lambda active_alert: active_alert['id'], active_alerts)))
+
+def retrieve_new_alerts(account=None, alerts=None, before_claim=None, claimed_by=None):
+    '''
+    Returns alerts the account hasn't seen yet and records them in its
+    database. Pass alerts to reuse an NWS fetch shared with other accounts.
+    before_claim is called with the unseen alerts before any is claimed, so
+    a caller can queue them somewhere durable first, and claimed_by is
+    stored with each claim so the caller can recognise its own claims later.
+    '''
+    account = account or account_info()
+    dynamo = get_database(account)
+
+    # Make API call to retrieve alerts, stopping early if nothing changed
+    fetched = alerts is None
+    if fetched:
+        alerts = get_alerts(creds[account]['api_endpoint'], account)
+        if alerts is None:
+            print('----')
+            print('Alerts not modified since last run')
+            return []
+
+    # Retrieve active alerts from the database
+    with metrics.span('db_scan'):
+        active_alerts = dynamo.get_all()
+
+    # Remove expired alerts from database
+    with metrics.span('db_delete'):
+        dynamo.delete_many([expired_alert['id'] for expired_alert in find_expired_alerts(active_alerts)])
+
+    candidates = find_new_alerts(alerts, active_alerts)
+    if before_claim:
+        before_claim(candidates)
+
+    # Store any new alerts since the script last ran. The conditional put
+    # keeps two overlapping runs from both claiming the same alert
+    with metrics.span('db_claim'):
+        new_alerts = [candidate for candidate in candidates if dynamo.put_if_absent(alert_record(candidate, claimed_by))]
+    metrics.count('alerts_new', len(new_alerts))
+
+    print_alert_summary(new_alerts, active_alerts)
+
+    if fetched:
+        confirm_validators(alerts_url(creds[account]['api_endpoint']), account)
     
     return new_alerts
 
-def log_alerts_messages():
-    [print(f"{message['message'][:270], message['media']}") for message in aggregate_message_and_media()]     
+def log_alerts_messages(account=None):
+    messages = aggregate_message_and_media(account)
+    [print(f"{message['message'][:270], message['media']}") for message in messages]     
     print(f'{datetime.utcnow()} - Alerts logging ran successfully')
-    cleanup()
+    cleanup_uploads(messages)
+
+def release_claims(messages, account):
+    '''
+    Removes unposted alerts from the database so the next run detects and
+    retries them. The endpoint's HTTP validators were already confirmed when
+    the alerts were claimed, so they are dropped too, or the next poll would
+    get a 304 and not see the released alerts until NWS changed its payload.
+    '''
+    ids = [message['id'] for message in messages if message.get('id')]
+    if ids:
+        print(f'Releasing {len(ids)} unposted alerts for the next run: {ids}')
+        metrics.count('posts_released', len(ids))
+        get_database(account).delete_many(ids)
+        forget_validators(alerts_url(creds[account]['api_endpoint']))
+
+def send_tweet(message, account=None):
+    '''Posts one message through the account's rate-limited client, releasing its claim if it fails'''
+    send_tweets([message], account)
+
+def send_tweets(messages, account=None):
+    '''
+    Posts a batch of messages, most urgent first when they compete for the
+    rate limit. Alerts that failed for a transient reason (rate limits,
+    server or network errors) are released for the next run. Returns them.
+    '''
+    from poster import post_messages
+    account = account or account_info()
+    unposted = post_messages(messages, account)
+    release_claims(unposted, account)
+    return unposted
 
-def send_tweets_alerts():
-    [tweet.tweet_image_from_web(message['media'], message['message']) for message in aggregate_message_and_media()]
+def cleanup_uploads(messages):
+    '''Deletes uploaded images from Cloudinary, skipping the API calls if nothing was uploaded'''
+    if any(message['media'] for message in messages):
+        with metrics.span('cloudinary_cleanup'):
+            cleanup()
+
+def send_tweets_alerts(account=None):
+    account = account or account_info()
+    messages = aggregate_message_and_media(account)
+    send_tweets(messages, account)
     print(f'{datetime.utcnow()} - Tweet alert code ran successfully!')
-    cleanup()
+    cleanup_uploads(messages)
+
+async def run_limited(semaphore, func, *args):
+    '''Runs a blocking call in a thread once the service's semaphore allows it'''
+    async with semaphore:
+        return await asyncio.to_thread(func, *args)
+
+async def retrieve_new_alerts_async(account, limits):
+    '''retrieve_new_alerts with the NWS fetch, scan, deletes and puts running concurrently'''
+    dynamo = get_database(account)
+    alerts = await asyncio.to_thread(get_alerts, creds[account]['api_endpoint'], account)
+    if alerts is None:
+        print('Alerts not modified since last run')
+        return []
+
+    with metrics.span('db_scan'):
+        active_alerts = await run_limited(limits['db'], dynamo.get_all)
+
+    candidates = find_new_alerts(alerts, active_alerts)
+    expired_ids = [expired_alert['id'] for expired_alert in find_expired_alerts(active_alerts)]
+    with metrics.span('db_claim'):
+        _, *claimed = await asyncio.gather(
+            run_limited(limits['db'], dynamo.delete_many, expired_ids),
+            *[run_limited(limits['db'], dynamo.put_if_absent, alert_record(candidate)) for candidate in candidates])
+    new_alerts = [candidate for candidate, is_new in zip(candidates, claimed) if is_new]
+    metrics.count('alerts_new', len(new_alerts))
+
+    print_alert_summary(new_alerts, active_alerts)
+    confirm_validators(alerts_url(creds[account]['api_endpoint']), account)
+
+    return new_alerts
+
+async def prepare_message_async(alert, account, render_pool, limits):
+    '''Renders the map in the process pool, then uploads it if the account needs overlays'''
+    from auto_polygon import render_map_variants
+
+    try:
+        with metrics.span('create_map'):
+            images = await asyncio.get_running_loop().run_in_executor(
+                render_pool, render_map_variants, alert, [overlay_key(alert, account)])
+    except Exception as e:
+        print(f"Unable to render map for {alert['properties']['id']}: {e}")
+        metrics.count('map_failures')
+        images = None
+
+    media = await run_limited(limits['upload'], prepare_alert_media, alert, images, account)
+    return alert_message(alert, media)
+
+async def send_tweets_alerts_async(account=None):
+    '''
+    Asyncio version of send_tweets_alerts. Database calls, renders and uploads
+    for every alert run concurrently within the per-service limits, while
+    tweets still go out one at a time in issuance order.
+    '''
+    account = account or account_info()
+    limits = {service: asyncio.Semaphore(limit) for service, limit in
+              {**CONCURRENCY_LIMITS, **creds[account].get('concurrency', {})}.items()}
+
+    tweetable_alerts = find_tweetable_alerts(await retrieve_new_alerts_async(account, limits))
+
+    if not tweetable_alerts:
+        print(f'{datetime.utcnow()} - Tweet alert code ran successfully!')
+        return
+
+    sent_messages = []
+    with ProcessPoolExecutor(max_workers=render_workers()) as render_pool:
+        messages = [asyncio.create_task(prepare_message_async(alert, account, render_pool, limits)) for alert in tweetable_alerts]
+
+        # Post each message as soon as it and every earlier one is ready
+        for message in messages:
+            sent_messages.append(await message)
+            await run_limited(limits['twitter'], send_tweet, sent_messages[-1], account)
+
+    print(f'{datetime.utcnow()} - Tweet alert code ran successfully!')
+    await asyncio.to_thread(cleanup_uploads, sent_messages)
+
+def send_tweets_alerts_multi(accounts):
+    '''
+    Runs several accounts in a single pass. Each NWS endpoint is fetched once,
+    each new alert map is rendered once and overlaid once per overlay setting,
+    then every account checks its own database and tweets with its own
+    credentials.
+    '''
+    endpoints = {}
+    for account in accounts:
+        endpoints.setdefault(creds[account]['api_endpoint'], []).append(account)
+
+    account_alerts = {}
+    for endpoint, endpoint_accounts in endpoints.items():
+        key = ','.join(endpoint_accounts)
+        alerts = get_alerts(endpoint, key)
+        for account in endpoint_accounts:
+            account_alerts[account] = find_tweetable_alerts(retrieve_new_alerts(account, alerts)) if alerts is not None else []
+        confirm_validators(alerts_url(endpoint), key)
+
+    unique_alerts = {alert['properties']['id']: alert for alerts in account_alerts.values() for alert in alerts}
+    overlays = {}
+    for account in accounts:
+        for alert in account_alerts[account]:
+            overlays.setdefault(alert['properties']['id'], set()).add(overlay_key(alert, account))
+    images = (dict(zip(unique_alerts, render_alert_maps(list(unique_alerts.values()), render_workers(),
+                                                        [list(overlays[id]) for id in unique_alerts])))
+              if unique_alerts else {})
+
+    media = {}
+    for account in accounts:
+        messages = []
+        for alert in account_alerts[account]:
+            key = (alert['properties']['id'], overlay_key(alert, account), creds[account]['overlays'])
+            if key not in media:
+                media[key] = prepare_alert_media(alert, images[key[0]], account)
+            messages.append(alert_message(alert, media[key]))
+        send_tweets(messages, account)
+
+    print(f'{datetime.utcnow()} - Tweet alert code ran successfully for {", ".join(accounts)}!')
+    cleanup_uploads(list(media.values()))
 
 if __name__ == '__main__':
     #log_alerts_messages()
-    send_tweets_alerts()
\ No newline at end of file
+    with metrics.run('alerts'):
+        if account_list():
+            send_tweets_alerts_multi(account_list())
+        elif use_asyncio():
+            asyncio.run(send_tweets_alerts_async())
+        else:
+            send_tweets_alerts()
\ No newline at end of file
@@ -1,56 +1,87 @@
 #!/usr/bin/env python
+import io
 import os
 import sys
 
-from cloudinary.api import delete_resources_by_tag, resources_by_tag
-from cloudinary.uploader import upload
-from cloudinary.utils import cloudinary_url
-from cloudinary import CloudinaryImage
+import metrics
 
-# config
+# config. Relative paths used across the project resolve from the script directory
 os.chdir(os.path.join(os.path.dirname(sys.argv[0]), '.'))
-if os.path.exists('settings.py'):
-    exec(open('settings.py').read())
 
 DEFAULT_TAG = "alert_basic"
 
+# Named Cloudinary overlays applied to each alert type
+OVERLAYS = {
+    'Tornado Warning': 'Overlays:Tornado',
+    'Severe Thunderstorm Warning': 'Overlays:Severe',
+    'Flash Flood Warning': 'Overlays:Flash'
+}
+DEFAULT_OVERLAY = 'Overlays:Default'
+
+configured = False
+
+def configure():
+    '''
+    Imports the Cloudinary SDK and applies settings.py the first time an
+    image is uploaded or cleaned up, so runs without uploads skip both
+    '''
+    global configured, upload, cloudinary_url, CloudinaryImage, delete_resources_by_tag, resources_by_tag
+
+    if configured:
+        return
+
+    from cloudinary.api import delete_resources_by_tag, resources_by_tag
+    from cloudinary.uploader import upload
+    from cloudinary.utils import cloudinary_url
+    from cloudinary import CloudinaryImage
+
+    if os.path.exists('settings.py'):
+        exec(open('settings.py').read(), globals())
+
+    configured = True
+
 def dump_response(response):
     print("Upload response:")
     for key in sorted(response.keys()):
         print("  %s: %s" % (key, response[key]))
 
 
-def upload_files():
-    print("--- Upload a local file")
-    response = upload("alert_visual.png", tags=DEFAULT_TAG)
+@metrics.timed('cloudinary_upload')
+def upload_files(image=None):
+    '''
+    Uploads a local file, or image bytes rendered in memory. Defaults to the
+    file create_map writes for IMAGE_FORMAT (i.e. alert_visual.jpg)
+    '''
+    if image is None:
+        from image_encoder import image_filename
+        image = image_filename()
+    configure()
+    print("--- Upload a local file" if isinstance(image, str) else "--- Upload an in-memory image")
+    response = upload(io.BytesIO(image) if isinstance(image, bytes) else image, tags=DEFAULT_TAG)
     return response
 
 def determine_overlay(event):
     ''' Determines appropriate overlay on the Cloudinary server '''
 
-    return {
-        'Tornado Warning': 'Overlays:Tornado',
-        'Severe Thunderstorm Warning': 'Overlays:Severe',
-        'Flash Flood Warning': 'Overlays:Flash'
-    }.get(event, 'Overlays:Default')
+    return OVERLAYS.get(event, DEFAULT_OVERLAY)
 
 def extract_url(src):
     image_url = src.split('"')[1]
     return image_url
 
-def upload_and_no_transform():
-    ''' Uploads file to cloudinary and returns image URL '''
-    response = upload_files()
+def upload_and_no_transform(image=None):
+    ''' Uploads file or image bytes to cloudinary and returns image URL '''
+    response = upload_files(image)
     image_url = cloudinary_url(response['public_id'], format=response['format'])
     print(image_url[0])
     return image_url[0]
 
-def upload_and_transform(event):
+def upload_and_transform(event, image=None):
     ''' 
     Uploads file to cloudinary, selects appropriate overlay based on the
     alert type, and returns the image URL
     '''
-    response = upload_files()
+    response = upload_files(image)
     
     image_src = CloudinaryImage(f"{response['public_id']}.{response['format']}").image(
         transformation=[ {'overlay': determine_overlay(event)} ])
@@ -79,6 +110,7 @@ def upload_and_multiple_transform():
 
 
 def cleanup():
+    configure()
     response = resources_by_tag(DEFAULT_TAG)
     resources = response.get('resources', [])
     if not resources:
@@ -89,14 +121,15 @@ def cleanup():
     print("Done!")
 
 
-if len(sys.argv) > 1:
-    if sys.argv[1] == 'upload':
-        upload_files()
-    if sys.argv[1] == 'cleanup':
-        cleanup()
-else:
-    print("--- Uploading files and then cleaning up")
-    print("    you can only choose one instead by passing 'upload' or 'cleanup' as an argument")
-    print("")
-    #upload_and_transform('Tornado Warning')
-    #cleanup()
\ No newline at end of file
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        if sys.argv[1] == 'upload':
+            upload_files()
+        if sys.argv[1] == 'cleanup':
+            cleanup()
+    else:
+        print("--- Uploading files and then cleaning up")
+        print("    you can only choose one instead by passing 'upload' or 'cleanup' as an argument")
+        print("")
+        #upload_and_transform('Tornado Warning')
+        #cleanup()
\ No newline at end of file
@@ -0,0 +1,148 @@
+'''
+Pre-rendered static map layers for create_map
+
+The tiles, county lines and state lines only depend on the map extent, so they
+are rendered once per extent bucket (the alert extent rounded outward to a
+BASEMAP_GRID degree grid) and kept as RGBA rasters in memory and on disk.
+The most recently used BASEMAP_MEMORY_EXTENTS buckets stay in memory, and
+the least recently drawn files are removed once BASEMAP_CACHE_DIR grows past
+BASEMAP_CACHE_MAX_MB.
+Two layers are cached because the radar is drawn between them:
+
+    tiles    opaque GoogleTiles background (below the radar)
+    borders  transparent county and state lines (above the radar)
+'''
+import math
+import os
+import time
+from collections import OrderedDict
+
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from metpy.plots import USCOUNTIES
+from cartopy import crs as ccrs
+import cartopy.feature as cfeature
+
+from geometry_lod import lod_level, states_scale
+
+from tile_cache import shared_tiles
+
+FIGSIZE = (1280/72, 720/72)
+DPI = 72
+BASEMAP_GRID = 0.25
+BASEMAP_CACHE_DIR = os.environ.get('BASEMAP_CACHE_DIR', 'basemap_cache')
+BASEMAP_CACHE_MAX_MB = float(os.environ.get('BASEMAP_CACHE_MAX_MB', 512))
+BASEMAP_MEMORY_EXTENTS = int(os.environ.get('BASEMAP_MEMORY_EXTENTS', 8))
+
+data_crs = ccrs.PlateCarree()
+basemap_layers = OrderedDict()
+
+def quantize_extent(extent, grid=BASEMAP_GRID):
+    '''Rounds a [west, east, south, north] extent outward to the basemap grid'''
+    west, east, south, north = extent
+    return (round(math.floor(west / grid) * grid, 4), round(math.ceil(east / grid) * grid, 4),
+            round(math.floor(south / grid) * grid, 4), round(math.ceil(north / grid) * grid, 4))
+
+def setup_axes(fig, extent):
+    ''' Adds full-figure map axes covering the extent '''
+    ax = fig.add_axes([0, 0, 1, 1], projection=data_crs)
+    ax.set_extent(extent, data_crs)
+    ax.set_adjustable('datalim')
+    return ax
+
+def add_tiles(ax):
+    ax.add_image(shared_tiles(), 8)
+
+def add_borders(ax, level=0):
+    '''Draws county and state lines, using coarser state lines for wide geometry_lod levels'''
+    ax.add_feature(USCOUNTIES.with_scale('20m'), edgecolor='gray', zorder=5, linewidth=1.2)
+    ax.add_feature(cfeature.STATES.with_scale(states_scale(level)), linewidth=3, zorder=5)
+
+def render_layer(extent, draw, transparent=False):
+    '''Renders one static layer and returns its RGBA pixels and final axes limits'''
+    fig = Figure(figsize=FIGSIZE, dpi=DPI)
+    canvas = FigureCanvasAgg(fig)
+    ax = setup_axes(fig, extent)
+    draw(ax)
+
+    if transparent:
+        fig.patch.set_alpha(0)
+        ax.patch.set_visible(False)
+
+    canvas.draw()
+    limits = (*ax.get_xlim(), *ax.get_ylim())
+    return np.asarray(canvas.buffer_rgba()).copy(), limits
+
+def layer_path(extent):
+    return os.path.join(BASEMAP_CACHE_DIR, '{}_{}_{}_{}_lod{}.npz'.format(*extent, lod_level(extent)))
+
+def is_layer_file(name):
+    '''Whether a file is a finished layer file rather than another process's temporary file'''
+    return name.endswith('.npz') and not name.endswith('.tmp.npz')
+
+def evict_layer_files(max_bytes=None):
+    '''Removes the least recently drawn layer files until the cache fits in BASEMAP_CACHE_MAX_MB'''
+    max_bytes = max_bytes if max_bytes is not None else BASEMAP_CACHE_MAX_MB * 1024 * 1024
+
+    files = []
+    for name in os.listdir(BASEMAP_CACHE_DIR):
+        if is_layer_file(name):
+            try:
+                stat = os.stat(os.path.join(BASEMAP_CACHE_DIR, name))
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_atime, stat.st_size, name))
+
+    cache_bytes = sum(size for _, size, _ in files)
+    for _, size, name in sorted(files):
+        if cache_bytes <= max_bytes:
+            break
+        try:
+            os.remove(os.path.join(BASEMAP_CACHE_DIR, name))
+        except FileNotFoundError:
+            pass
+        cache_bytes -= size
+
+def get_basemap_layers(extent):
+    '''
+    Returns the cached tiles and borders rasters for a quantized extent,
+    rendering and storing them on a miss
+    '''
+    if extent in basemap_layers:
+        basemap_layers.move_to_end(extent)
+        return basemap_layers[extent]
+
+    path = layer_path(extent)
+
+    if os.path.exists(path):
+        with np.load(path) as cached:
+            layers = {'tiles': cached['tiles'], 'borders': cached['borders'],
+                      'limits': tuple(cached['limits'])}
+        os.utime(path, (time.time(), os.path.getmtime(path)))
+    else:
+        tiles, limits = render_layer(extent, add_tiles)
+        borders, _ = render_layer(extent, lambda ax: add_borders(ax, lod_level(extent)), transparent=True)
+        layers = {'tiles': tiles, 'borders': borders, 'limits': limits}
+
+        os.makedirs(BASEMAP_CACHE_DIR, exist_ok=True)
+        temp_path = f'{path}.{os.getpid()}.tmp.npz'
+        np.savez_compressed(temp_path, tiles=tiles, borders=borders, limits=np.array(limits))
+        os.replace(temp_path, path)
+        evict_layer_files()
+
+    basemap_layers[extent] = layers
+    while len(basemap_layers) > BASEMAP_MEMORY_EXTENTS:
+        basemap_layers.popitem(last=False)
+    return layers
+
+def add_basemap(ax, layers):
+    '''Draws the cached layers onto axes and pins the axes to their limits'''
+    x0, x1, y0, y1 = layers['limits']
+
+    ax.imshow(layers['tiles'], extent=(x0, x1, y0, y1), origin='upper',
+              transform=data_crs, interpolation='nearest', zorder=0)
+    ax.imshow(layers['borders'], extent=(x0, x1, y0, y1), origin='upper',
+              transform=data_crs, interpolation='nearest', zorder=5)
+    ax.set_xlim(x0, x1)
+    ax.set_ylim(y0, y1)
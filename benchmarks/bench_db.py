@@ -0,0 +1,79 @@
+'''
+Compares DynamoDB request counts and latency of the old alert bookkeeping
+(single-page scan, one put and one delete per alert) against the paginated
+scan, batch writes and conditional puts in db.Database.
+
+Runs against a local DynamoDB stand-in such as DynamoDB Local:
+    docker run -p 8000:8000 amazon/dynamodb-local
+    DYNAMODB_ENDPOINT_URL=http://localhost:8000 python benchmarks/bench_db.py
+'''
+import argparse
+import json
+import os
+import sys
+import time
+import uuid
+from collections import Counter
+
+import boto3
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from db import DynamoDatabase
+
+def create_table(name):
+    dynamodb = boto3.resource('dynamodb', region_name='us-east-1',
+                              endpoint_url=os.environ['DYNAMODB_ENDPOINT_URL'])
+    table = dynamodb.create_table(
+        TableName=name,
+        KeySchema=[{'AttributeName': 'id', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'id', 'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST')
+    table.wait_until_exists()
+    return table
+
+def count_requests(database):
+    '''Counts DynamoDB API calls made through the database's client'''
+    counts = Counter()
+    database.table.meta.client.meta.events.register(
+        'before-send.dynamodb.*', lambda request, **kwargs: counts.update([request.headers['X-Amz-Target'].decode().split('.')[-1]]))
+    return counts
+
+def fake_alerts(count):
+    return [{'id': f'urn:oid:2.49.0.1.840.0.{uuid.uuid4().hex}', 'event': 'Flood Warning',
+             'areaDesc': 'Alachua; Marion', 'expires': '2020-01-01T00:00:00-05:00',
+             'padding': 'x' * 2500} for _ in range(count)]
+
+def old_pattern(database, alerts):
+    [database.put(alert) for alert in alerts]
+    active = database.table.scan()['Items']
+    [database.delete(alert['id']) for alert in active]
+    return len(active)
+
+def new_pattern(database, alerts):
+    claimed = sum(database.put_if_absent(alert) for alert in alerts[:len(alerts) // 2])
+    database.put_many(alerts[len(alerts) // 2:])
+    active = database.get_all()
+    database.delete_many([alert['id'] for alert in active])
+    return len(active), claimed
+
+def run(name, func, alerts):
+    os.environ['BENCH_TABLE'] = f'bench-{name}-{uuid.uuid4().hex[:8]}'
+    table = create_table(os.environ['BENCH_TABLE'])
+    database = DynamoDatabase('BENCH_TABLE')
+    counts = count_requests(database)
+
+    start = time.perf_counter()
+    result = func(database, alerts)
+    elapsed = time.perf_counter() - start
+
+    table.delete()
+    return {'pattern': name, 'seconds': elapsed, 'requests': sum(counts.values()),
+            'by_operation': dict(counts), 'result': result}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--alerts', type=int, default=500)
+    args = parser.parse_args()
+
+    alerts = fake_alerts(args.alerts)
+    print(json.dumps([run('old', old_pattern, alerts), run('new', new_pattern, alerts)], indent=2))
@@ -0,0 +1,70 @@
+'''
+Compares image formats on alert maps rendered from the benchmark fixtures.
+
+Each fixture is drawn once offline (with the bench_render stand-ins) and its
+Agg canvas pixels are then encoded in every image_encoder format. Reports the
+median encode time, encoded bytes and how far the decoded image is from the
+canvas: PSNR in dB (higher is closer, inf is lossless) and the share of
+pixels off by more than 16 in any channel.
+
+Usage: python benchmarks/bench_encode.py [--runs 10] [--formats png png8 jpeg webp]
+'''
+import argparse
+import copy
+import glob
+import io
+import json
+import os
+import statistics
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+from bench_render import FIXTURE_DIR, REPO_DIR, start_stand_ins
+
+def visual_diff(original, data):
+    decoded = np.asarray(Image.open(io.BytesIO(data)).convert('RGB')).astype('int16')
+    error = np.abs(decoded - original.astype('int16'))
+    mse = float(np.mean(error.astype('float64') ** 2))
+    return {'psnr_db': float('inf') if mse == 0 else 10 * np.log10(255 ** 2 / mse),
+            'changed_pixels': float(np.mean(error.max(axis=2) > 16))}
+
+def benchmark(pixels, formats, runs):
+    from image_encoder import encode_rgb
+
+    results = {}
+    for image_format in formats:
+        times = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            data = encode_rgb(pixels, image_format)
+            times.append(time.perf_counter() - start)
+        results[image_format] = {'encode_seconds': statistics.median(times), 'bytes': len(data),
+                                 **visual_diff(pixels, data)}
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--formats', nargs='+', default=['png', 'png8', 'jpeg', 'webp'])
+    parser.add_argument('--fixtures', nargs='+', default=sorted(glob.glob(os.path.join(FIXTURE_DIR, '*.json'))))
+    args = parser.parse_args()
+
+    server, _ = start_stand_ins()
+    sys.path.insert(0, REPO_DIR)
+    os.chdir(REPO_DIR)
+    from auto_polygon import draw_map
+    from image_encoder import canvas_rgb
+
+    report = []
+    for path in args.fixtures:
+        with open(path) as f:
+            alert = json.load(f)
+        pixels = canvas_rgb(draw_map(copy.deepcopy(alert))).copy()
+        report.append({'fixture': os.path.splitext(os.path.basename(path))[0],
+                       'formats': benchmark(pixels, args.formats, args.runs)})
+
+    server.shutdown()
+    print(json.dumps(report, indent=2))
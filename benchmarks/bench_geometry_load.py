@@ -0,0 +1,49 @@
+'''
+Compares startup time and resident memory of resolving UGC geography from the
+nationwide shapefiles versus the state-filtered geometry cache.
+
+Each mode runs in a fresh interpreter so import and page cache effects are
+comparable. Build the cache first with: python geometry_cache.py
+
+Usage: python benchmarks/bench_geometry_load.py [--codes FLC025 FLZ050 ...]
+'''
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = '''
+import json, resource, sys, time
+start = time.perf_counter()
+import geometry_cache
+if sys.argv[1] == 'shapefile':
+    index = geometry_cache.build_ugc_index(*geometry_cache.read_shapefiles())
+else:
+    index = geometry_cache.CachedUGCIndex()
+loaded = time.perf_counter()
+resolved = [index.get(code) for code in sys.argv[2:]]
+done = time.perf_counter()
+print(json.dumps({
+    'mode': sys.argv[1],
+    'load_seconds': loaded - start,
+    'lookup_seconds': done - loaded,
+    'resolved': sum(entry is not None for entry in resolved),
+    'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+}))
+'''
+
+def run(mode, codes):
+    output = subprocess.run([sys.executable, '-c', CHILD, mode, *codes],
+                            cwd=REPO_DIR, capture_output=True, text=True, check=True)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--codes', nargs='+', default=['FLC025', 'FLC086', 'FLC011', 'FLZ050', 'FLZ151', 'SCC019'])
+    args = parser.parse_args()
+
+    results = [run(mode, args.codes) for mode in ('shapefile', 'cache')]
+    print(json.dumps(results, indent=2))
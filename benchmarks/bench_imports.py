@@ -0,0 +1,83 @@
+'''
+Tracks the import-time cost of each entry point with python -X importtime
+
+Every module is imported in a fresh interpreter, several times, and the
+median cumulative import time is reported along with the slowest imports
+it pulled in. Append results to a JSON lines file with --output to follow
+startup cost across commits.
+
+Usage: python benchmarks/bench_imports.py [--runs 5] [--output import_times.jsonl]
+'''
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ENTRY_POINTS = ['auto_tweet', 'auto_radar', 'auto_story', 'daemon']
+
+# accounts.py reads these at import time
+ACCOUNT_ENV_VARS = [
+    f'TWITTER_{key}{suffix}'
+    for key in ('CONSUMER_KEY', 'CONSUMER_SECRET', 'ACCESS_TOKEN', 'ACCESS_TOKEN_SECRET')
+    for suffix in ('_FLORIDA', '_PALMETTO', '')
+]
+
+IMPORTTIME_LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)')
+
+def parse_importtime(stderr):
+    '''Returns {module: cumulative microseconds} for top-level and nested imports'''
+    times = {}
+    for line in stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match:
+            times[match.group(4)] = int(match.group(2))
+    return times
+
+def measure(module):
+    env = {**os.environ, **{var: os.environ.get(var, 'benchmark') for var in ACCOUNT_ENV_VARS}}
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            cwd=REPO_DIR, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        return None, result.stderr.strip().splitlines()[-1]
+    return parse_importtime(result.stderr), None
+
+def benchmark(module, runs):
+    samples = []
+    for _ in range(runs):
+        times, error = measure(module)
+        if error:
+            return {'module': module, 'error': error}
+        samples.append(times)
+
+    heaviest = sorted(samples[-1].items(), key=lambda item: item[1], reverse=True)
+    return {
+        'module': module,
+        'median_ms': statistics.median(sample[module] for sample in samples) / 1000,
+        'heaviest_imports_ms': {name: us / 1000 for name, us in heaviest[1:11]},
+        'modules_imported': len(samples[-1])
+    }
+
+def git_revision():
+    result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True)
+    return result.stdout.strip() or None
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--modules', nargs='+', default=ENTRY_POINTS)
+    parser.add_argument('--output', help='JSON lines file to append the report to')
+    args = parser.parse_args()
+
+    report = {'timestamp': time.time(), 'revision': git_revision(), 'python': sys.version.split()[0],
+              'results': [benchmark(module, args.runs) for module in args.modules]}
+    print(json.dumps(report, indent=2))
+
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write(json.dumps(report) + '\n')
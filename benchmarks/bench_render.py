@@ -0,0 +1,255 @@
+'''
+Replays recorded alert fixtures through render_map with no network access.
+
+Google tiles, the IEM n0q timestamp JSON and the IEM WMS are served by a local
+stand-in server (synthetic tiles and radar), and every cache directory points
+at a fresh temporary directory. Each fixture is rendered once cold (empty tile,
+basemap and radar caches) and then --runs times warm, for both the layered and
+the direct-drawing path. Stages:
+
+    geometry   convert_geojson_to_geopandas_df / calculate_ugc_geography
+    basemap    tiles and borders (rendered layers or drawn directly)
+    tiles      tile fetches from the stand-in or the tile cache (part of basemap)
+    radar      radar timestamp, frame fetch/decode and drawing
+    features   alert polygons and title (the rest of draw_map)
+    savefig    Agg rasterization and image encoding (IMAGE_FORMAT)
+
+Peak traced Python/numpy memory per fixture comes from a separate tracemalloc
+run so tracing does not inflate the timings.
+
+The geometry cache (python geometry_cache.py) and cartopy's Natural Earth and
+metpy's county data must already be on disk, as they are on a deployed box.
+
+Usage: python benchmarks/bench_render.py [--runs 5] [--output report.json] [--compare baseline.json]
+'''
+import argparse
+import copy
+import functools
+import glob
+import io
+import json
+import os
+import platform
+import resource
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+from PIL import Image
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURE_DIR = os.path.join(REPO_DIR, 'benchmarks', 'fixtures', 'alerts')
+STAGES = ['geometry', 'basemap', 'tiles', 'radar', 'features', 'savefig', 'total']
+
+def encode_png(pixels):
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+@functools.lru_cache(maxsize=None)
+def synthetic_tile(x, y, z):
+    '''Land-coloured noise so PNG decoding costs about what a real tile does'''
+    rng = np.random.default_rng(x * 7919 + y * 104729 + z)
+    pixels = np.full((256, 256, 3), (232, 230, 222), dtype=np.int16)
+    pixels += rng.integers(-12, 12, (256, 256, 1), dtype=np.int16)
+    return encode_png(pixels.clip(0, 255).astype(np.uint8))
+
+@functools.lru_cache(maxsize=None)
+def synthetic_radar(width, height):
+    '''Transparent frame with a band of reflectivity-coloured echoes'''
+    rng = np.random.default_rng(0)
+    pixels = np.zeros((height, width, 4), dtype=np.uint8)
+    rows, cols = np.indices((height, width))
+    echo = np.sin(cols / 40.0) + np.cos(rows / 55.0) + rng.normal(0, 0.3, (height, width)) > 1.2
+    pixels[echo] = (0, 200, 60, 255)
+    pixels[echo & (rng.random((height, width)) > 0.8)] = (255, 200, 0, 255)
+    return encode_png(pixels)
+
+class StandInHandler(BaseHTTPRequestHandler):
+    '''Serves /tiles/z/x/y.png, /radar/n0q_0.json and /radar/wms'''
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = url.path.strip('/').split('/')
+
+        if parts[0] == 'tiles':
+            z, x, y = (int(part.split('.')[0]) for part in parts[1:4])
+            self.reply(synthetic_tile(x, y, z), 'image/png')
+        elif url.path == '/radar/n0q_0.json':
+            self.reply(json.dumps({'meta': {'valid': '2024-05-10T18:30:00Z'}}).encode(), 'application/json')
+        elif url.path == '/radar/wms':
+            query = parse_qs(url.query)
+            self.reply(synthetic_radar(int(query['width'][0]), int(query['height'][0])), 'image/png')
+        else:
+            self.send_error(404)
+
+    def reply(self, body, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def start_stand_ins():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f'http://127.0.0.1:{server.server_address[1]}'
+
+    cache_root = tempfile.mkdtemp(prefix='bench_render_')
+    os.environ.update({
+        'TILE_URL': base + '/tiles/{z}/{x}/{y}.png',
+        'RADAR_TIMESTAMP_URL': base + '/radar/n0q_0.json',
+        'RADAR_WMS_URL': base + '/radar/wms?',
+        'TILE_CACHE_DIR': os.path.join(cache_root, 'tiles'),
+        'BASEMAP_CACHE_DIR': os.path.join(cache_root, 'basemap'),
+        'RADAR_FRAME_DIR': os.path.join(cache_root, 'radar'),
+    })
+    return server, cache_root
+
+class StageTimer:
+    '''Accumulates wall time spent in wrapped functions, per stage'''
+
+    def __init__(self):
+        self.seconds = {}
+
+    def wrap(self, stage, func):
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.seconds[stage] = self.seconds.get(stage, 0) + time.perf_counter() - start
+        return timed
+
+def instrument(timer):
+    '''Wraps the functions of each stage where auto_polygon looks them up'''
+    import auto_polygon
+    import tile_cache
+
+    for stage, names in [('geometry', ['convert_geojson_to_geopandas_df', 'calculate_ugc_geography']),
+                         ('basemap', ['get_basemap_layers', 'add_basemap', 'add_tiles', 'add_borders']),
+                         ('radar', ['add_radar']),
+                         ('draw', ['draw_map'])]:
+        for name in names:
+            setattr(auto_polygon, name, timer.wrap(stage, getattr(auto_polygon, name)))
+
+    tile_cache.CachedGoogleTiles.tile_data = timer.wrap('tiles', tile_cache.CachedGoogleTiles.tile_data)
+    return auto_polygon
+
+def clear_caches(cache_root):
+    import basemap
+    import radar_frame
+    import shutil
+
+    basemap.basemap_layers.clear()
+    radar_frame.radar_frames.clear()
+    radar_frame.radar_timestamp.update({'valid': None, 'checked': 0})
+    for name in ('tiles', 'basemap', 'radar'):
+        shutil.rmtree(os.path.join(cache_root, name), ignore_errors=True)
+
+def render_once(auto_polygon, timer, alert, layered):
+    timer.seconds = {}
+    start = time.perf_counter()
+    image = auto_polygon.render_map(copy.deepcopy(alert), layered)
+    total = time.perf_counter() - start
+
+    seconds = timer.seconds
+    draw = seconds.pop('draw', 0)
+    stages = {stage: seconds.get(stage, 0) for stage in ('geometry', 'basemap', 'tiles', 'radar')}
+    stages['features'] = draw - stages['geometry'] - stages['basemap'] - stages['radar']
+    stages['savefig'] = total - draw
+    stages['total'] = total
+    return stages, len(image)
+
+def summarize(samples):
+    return {stage: {'median': statistics.median(sample[stage] for sample in samples),
+                    'min': min(sample[stage] for sample in samples)} for stage in STAGES}
+
+def peak_memory(auto_polygon, alert, layered):
+    tracemalloc.start()
+    auto_polygon.render_map(copy.deepcopy(alert), layered)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak / 1024 / 1024
+
+def benchmark(fixtures, runs, cache_root):
+    timer = StageTimer()
+    auto_polygon = instrument(timer)
+    results = []
+
+    for path in fixtures:
+        with open(path) as f:
+            alert = json.load(f)
+
+        for layered in (True, False):
+            clear_caches(cache_root)
+            cold, png_bytes = render_once(auto_polygon, timer, alert, layered)
+            warm = [render_once(auto_polygon, timer, alert, layered)[0] for _ in range(runs)]
+
+            results.append({
+                'fixture': os.path.splitext(os.path.basename(path))[0],
+                'layered': layered,
+                'cold': cold,
+                'warm': summarize(warm),
+                'png_bytes': png_bytes,
+                'peak_traced_mb': peak_memory(auto_polygon, alert, layered)
+            })
+            print(f"{results[-1]['fixture']:40} layered={layered!s:5} cold={cold['total']:.3f}s "
+                  f"warm={results[-1]['warm']['total']['median']:.3f}s", file=sys.stderr)
+
+    return results
+
+def compare(report, baseline):
+    '''Prints the change in warm median totals against an earlier report'''
+    previous = {(result['fixture'], result['layered']): result for result in baseline['results']}
+
+    for result in report['results']:
+        before = previous.get((result['fixture'], result['layered']))
+        if before is None:
+            continue
+        old, new = before['warm']['total']['median'], result['warm']['total']['median']
+        print(f"{result['fixture']:40} layered={result['layered']!s:5} {old:.3f}s -> {new:.3f}s "
+              f"({(new - old) / old:+.1%})", file=sys.stderr)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--fixtures', nargs='+', default=sorted(glob.glob(os.path.join(FIXTURE_DIR, '*.json'))))
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    parser.add_argument('--compare', help='earlier JSON report to compare warm totals against')
+    args = parser.parse_args()
+
+    server, cache_root = start_stand_ins()
+    sys.path.insert(0, REPO_DIR)
+    os.chdir(REPO_DIR)
+
+    import matplotlib
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'matplotlib': matplotlib.__version__,
+        'runs': args.runs,
+        'results': benchmark(args.fixtures, args.runs, cache_root),
+        'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    }
+    server.shutdown()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
@@ -0,0 +1,69 @@
+'''
+Times storm cell identification and tracking on a synthetic full-resolution
+Florida grid (1 km pixels over the regional radar subset) with a few hundred
+convective cells that move between two scans.
+
+Usage: python benchmarks/bench_storm_cells.py [--cells 300] [--runs 10]
+'''
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from storm_cells import identify_cells, track_cells
+
+# Regional subset at 1 km: ~1700 km west-east by ~1400 km south-north
+GRID_SHAPE = (1400, 1700)
+
+def synthetic_scan(centers, shape=GRID_SHAPE, seed=0):
+    '''Gaussian reflectivity blobs over light noise, with NaN where there is no echo'''
+    rng = np.random.default_rng(seed)
+    values = rng.normal(5, 5, shape).astype('float32')
+    rows, cols = np.indices((41, 41)) - 20
+
+    for row, col, radius, peak in centers:
+        blob = peak * np.exp(-(rows ** 2 + cols ** 2) / (2 * radius ** 2))
+        r0, c0 = int(row) - 20, int(col) - 20
+        if 0 <= r0 and r0 + 41 <= shape[0] and 0 <= c0 and c0 + 41 <= shape[1]:
+            window = values[r0:r0 + 41, c0:c0 + 41]
+            np.maximum(window, blob, out=window)
+
+    values[values < 0] = np.nan
+    return values
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cells', type=int, default=300)
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--threshold', type=float, default=30)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(1)
+    centers = np.column_stack([rng.uniform(20, GRID_SHAPE[0] - 21, args.cells), rng.uniform(20, GRID_SHAPE[1] - 21, args.cells),
+                               rng.uniform(3, 8, args.cells), rng.uniform(35, 65, args.cells)])
+    moved = centers + [2, 3, 0, 0]
+    x = np.arange(GRID_SHAPE[1]) * 1000.0
+    y = np.arange(GRID_SHAPE[0]) * 1000.0
+    first, second = synthetic_scan(centers), synthetic_scan(moved, seed=1)
+
+    identify_times, track_times = [], []
+    for _ in range(args.runs):
+        start = time.perf_counter()
+        previous = identify_cells(first, x, y, args.threshold)
+        current = identify_cells(second, x, y, args.threshold)
+        identified = time.perf_counter()
+        track_cells(previous, current, 300)
+        identify_times.append((identified - start) / 2)
+        track_times.append(time.perf_counter() - identified)
+
+    print(json.dumps({
+        'grid_shape': GRID_SHAPE,
+        'cells_found': len(current['x']),
+        'matched': int(np.isfinite(current['speed_kmh']).sum()),
+        'identify_ms_median': float(np.median(identify_times) * 1000),
+        'track_ms_median': float(np.median(track_times) * 1000)
+    }, indent=2))
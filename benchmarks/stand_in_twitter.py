@@ -0,0 +1,99 @@
+'''
+In-process stand-in for the tweepy API that enforces a rate limit and
+randomly fails, for exercising poster.py without posting anything.
+
+Each endpoint allows `limit` requests per `window` seconds, reports them in
+x-rate-limit-* headers like Twitter and answers 429 once they run out. A
+`failure_rate` share of the remaining requests fail with a 503.
+
+Run directly to post a burst of mixed alerts through poster.post_messages and
+print the post order, retries and time taken:
+
+Usage: python benchmarks/stand_in_twitter.py [--alerts 12] [--limit 5] [--window 10] [--failure-rate 0.1]
+'''
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+from types import SimpleNamespace
+
+class StandInError(Exception):
+    '''Carries a requests-like response, as tweepy's errors do'''
+
+    def __init__(self, status_code, headers):
+        super().__init__(f'Stand-in API returned {status_code}')
+        self.response = SimpleNamespace(status_code=status_code, headers=headers)
+
+class StandInAPI:
+
+    def __init__(self, limit=5, window=10, failure_rate=0.0, seed=0):
+        self.limit = limit
+        self.window = window
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.windows = {}
+        self.lock = threading.Lock()
+        self.last_response = None
+        self.statuses = []
+        self.responses = {}
+
+    def respond(self, endpoint):
+        '''Counts the request against its endpoint's window and raises if it is limited or fails'''
+        with self.lock:
+            now = time.time()
+            reset, used = self.windows.get(endpoint, (now + self.window, 0))
+            if now >= reset:
+                reset, used = now + self.window, 0
+
+            limited = used >= self.limit
+            used += 0 if limited else 1
+            self.windows[endpoint] = (reset, used)
+            headers = {'x-rate-limit-limit': str(self.limit),
+                       'x-rate-limit-remaining': str(self.limit - used),
+                       'x-rate-limit-reset': str(int(reset) + 1)}
+
+            status = 429 if limited else 503 if self.random.random() < self.failure_rate else 200
+            self.responses[status] = self.responses.get(status, 0) + 1
+            self.last_response = SimpleNamespace(status_code=status, headers=headers)
+
+        if status != 200:
+            raise StandInError(status, headers)
+
+    def media_upload(self, filename, file=None):
+        self.respond('media/upload')
+        return SimpleNamespace(media_id=len(self.statuses) + 1)
+
+    def update_status(self, status=None, media_ids=None):
+        self.respond('statuses/update')
+        self.statuses.append(status)
+        return SimpleNamespace(id=len(self.statuses), text=status)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--alerts', type=int, default=12)
+    parser.add_argument('--limit', type=int, default=5)
+    parser.add_argument('--window', type=float, default=10)
+    parser.add_argument('--failure-rate', type=float, default=0.1)
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import poster
+
+    poster.apis['stand_in'] = api = StandInAPI(args.limit, args.window, args.failure_rate)
+    poster.clients['stand_in'] = SimpleNamespace(get_hashtag='#FLwx')
+
+    events = ['Special Weather Statement', 'Tornado Watch', 'Severe Thunderstorm Warning', 'Tornado Warning']
+    messages = [{'message': f'{events[i % len(events)]} {i}', 'event': events[i % len(events)],
+                 'image': None, 'media': None} for i in range(args.alerts)]
+
+    start = time.perf_counter()
+    unposted = poster.post_messages(messages, 'stand_in')
+    print(json.dumps({
+        'seconds': time.perf_counter() - start,
+        'posted': api.statuses,
+        'unposted': [message['message'] for message in unposted],
+        'responses': api.responses
+    }, indent=2))
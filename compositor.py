@@ -0,0 +1,105 @@
+'''
+Local overlay compositing for accounts with overlays
+
+Applies the same named overlays as the Cloudinary transform in banner.py
+(determine_overlay) to the map's canvas pixels before the one encode step in
+auto_polygon.render_map_variants, so the image can go straight to Twitter
+media upload without an upload, a download and a cleanup.
+
+Overlay assets are RGBA PNGs in OVERLAY_DIR named after the overlay, e.g.
+overlays/Tornado.png for 'Overlays:Tornado'. Export them from Cloudinary once
+with `python compositor.py export`. Like Cloudinary, an overlay is centred on
+the map. The account's logo (logo_filename in accounts.creds) is placed in
+the bottom right corner if the account sets logo_overlay. Assets are decoded
+once per process and kept in memory.
+
+OVERLAY_MODE=cloudinary keeps the old server-side transform. In local mode
+alerts whose overlay asset is missing fall back to Cloudinary with a warning.
+
+Usage: python compositor.py export [--overlay-dir overlays]
+'''
+import argparse
+import os
+
+import numpy as np
+from PIL import Image
+
+from banner import OVERLAYS, DEFAULT_OVERLAY, determine_overlay
+
+OVERLAY_MODE = os.environ.get('OVERLAY_MODE', 'local')
+OVERLAY_DIR = os.environ.get('OVERLAY_DIR', 'overlays')
+LOGO_DIR = os.environ.get('LOGO_DIR', 'logos')
+LOGO_MARGIN = 20
+
+assets = {}
+
+def load_asset(path):
+    '''Returns a cached RGBA asset, or None if the file doesn't exist'''
+    if path not in assets:
+        assets[path] = Image.open(path).convert('RGBA') if os.path.exists(path) else None
+    return assets[path]
+
+def overlay_path(name, overlay_dir=OVERLAY_DIR):
+    return os.path.join(overlay_dir, f"{name.split(':', 1)[1]}.png")
+
+def overlay_asset(event):
+    path = overlay_path(determine_overlay(event))
+    if path not in assets and not os.path.exists(path):
+        print(f'Overlay asset {path} is missing, falling back to Cloudinary. Run: python compositor.py export')
+    return load_asset(path)
+
+def logo_asset(logo_filename):
+    return load_asset(os.path.join(LOGO_DIR, logo_filename)) if logo_filename else None
+
+def can_composite(event):
+    return OVERLAY_MODE == 'local' and overlay_asset(event) is not None
+
+def paste(frame, asset, position):
+    layer = Image.new('RGBA', frame.size, (0, 0, 0, 0))
+    layer.paste(asset, position)
+    return Image.alpha_composite(frame, layer)
+
+def composite(pixels, event, logo_filename=None):
+    '''Blends the event's overlay and the logo onto RGBA canvas pixels and returns RGB pixels'''
+    frame = Image.fromarray(np.ascontiguousarray(pixels), 'RGBA')
+    width, height = frame.size
+
+    overlay = overlay_asset(event)
+    if overlay is not None:
+        frame = (Image.alpha_composite(frame, overlay) if overlay.size == frame.size
+                 else paste(frame, overlay, ((width - overlay.width) // 2, (height - overlay.height) // 2)))
+
+    logo = logo_asset(logo_filename)
+    if logo is not None:
+        frame = paste(frame, logo, (width - logo.width - LOGO_MARGIN, height - logo.height - LOGO_MARGIN))
+
+    return np.asarray(frame)[..., :3]
+
+def export_overlays(overlay_dir=OVERLAY_DIR):
+    '''Downloads every named overlay from Cloudinary as a PNG asset'''
+    import banner
+    import http_client
+
+    banner.configure()
+    os.makedirs(overlay_dir, exist_ok=True)
+
+    for name in sorted(set(OVERLAYS.values()) | {DEFAULT_OVERLAY}):
+        url = banner.cloudinary_url(name.replace(':', '/'), format='png')[0]
+        response = http_client.get(url)
+        if response.status_code != 200:
+            print(f'Unable to export {name} from {url}. Status code: {response.status_code}')
+            continue
+
+        path = overlay_path(name, overlay_dir)
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(response.content)
+        os.replace(temp_path, path)
+        print(f'Exported {name} to {path}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['export'])
+    parser.add_argument('--overlay-dir', default=OVERLAY_DIR)
+    args = parser.parse_args()
+    export_overlays(args.overlay_dir)
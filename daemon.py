@@ -0,0 +1,165 @@
+'''
+Long-running scheduler for the alert, radar and story jobs
+
+Imports, shapefile caches, boto3 resources, Tweepy clients and HTTP
+connections stay warm in one process instead of being rebuilt by every cron
+invocation. Each job runs on its own interval plus random jitter. SIGTERM or
+SIGINT lets the running job and any outbox stage pass finish and then
+exits. GET /health on the status port (localhost only unless --host or
+HEALTH_HOST says otherwise) returns the state of every job as JSON. With
+--outbox the alerts job only detects and queues alerts, and outbox.py's
+stage workers render, upload and post them in background threads.
+
+Usage: python daemon.py --accounts florida_storms ray_hawthorne
+                        [--story-account ray_hawthorne] [--radar]
+                        [--alerts-interval 60] [--radar-interval 300]
+                        [--story-interval 900] [--jitter 5] [--port 8080]
+                        [--host 127.0.0.1] [--outbox]
+'''
+import argparse
+import json
+import os
+import random
+import signal
+import threading
+import time
+import traceback
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import auto_tweet
+import metrics
+
+stop_event = threading.Event()
+started = datetime.utcnow()
+
+# Outbox stage threads, joined on shutdown so an upload or post in progress can finish
+workers = []
+
+def make_job(name, func, interval):
+    return {'name': name, 'func': func, 'interval': interval, 'next_run': time.monotonic(),
+            'runs': 0, 'failures': 0, 'last_run': None, 'last_duration': None, 'last_error': None}
+
+def run_job(job, jitter):
+    '''Runs a job, records how it went and schedules its next run'''
+    start = time.monotonic()
+    job['last_run'] = datetime.utcnow().isoformat()
+
+    try:
+        with metrics.run(job['name']):
+            job['func']()
+    except Exception as e:
+        job['failures'] += 1
+        job['last_error'] = repr(e)
+        traceback.print_exc()
+    else:
+        job['last_error'] = None
+
+    job['runs'] += 1
+    job['last_duration'] = time.monotonic() - start
+    job['next_run'] = start + job['interval'] + random.uniform(-jitter, jitter)
+
+def job_status(jobs):
+    return {
+        'started': started.isoformat(),
+        'stopping': stop_event.is_set(),
+        'jobs': [{key: value for key, value in job.items() if key != 'func'} for job in jobs]
+    }
+
+def serve_health(jobs, port, host='127.0.0.1'):
+    '''
+    Serves GET /health with the job status from a background thread. The
+    status includes job error text, so it is only served on localhost unless
+    another host is given.
+    '''
+
+    class HealthHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/health':
+                self.send_error(404)
+                return
+
+            body = json.dumps(job_status(jobs)).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            return
+
+    server = ThreadingHTTPServer((host, port), HealthHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def build_jobs(args):
+    jobs = []
+
+    if args.accounts and args.outbox:
+        # Detection polls on the alerts interval while the stage workers drain the outbox
+        import outbox
+        box = outbox.Outbox()
+        workers.extend(outbox.start_workers(box, stop_event, max(1, args.workers)))
+        jobs.append(make_job('alerts', lambda: outbox.poll(box, args.accounts), args.alerts_interval))
+    elif args.accounts:
+        send_alerts = (
+            (lambda: auto_tweet.send_tweets_alerts(args.accounts[0])) if len(args.accounts) == 1
+            else (lambda: auto_tweet.send_tweets_alerts_multi(args.accounts)))
+        jobs.append(make_job('alerts', send_alerts, args.alerts_interval))
+
+    if args.radar:
+        import auto_radar
+        jobs.append(make_job('radar', auto_radar.main, args.radar_interval))
+
+    if args.story_account:
+        import auto_story
+        jobs.append(make_job('story', lambda: auto_story.main(args.story_account), args.story_interval))
+
+    return jobs
+
+def warm_up():
+    '''Loads what every alert map needs before the first tick'''
+    from auto_polygon import get_ugc_index
+    get_ugc_index()
+
+def main(args):
+    jobs = build_jobs(args)
+    if not jobs:
+        print('No jobs configured. Pass --accounts, --radar and/or --story-account')
+        return
+
+    signal.signal(signal.SIGTERM, lambda *_: stop_event.set())
+    signal.signal(signal.SIGINT, lambda *_: stop_event.set())
+
+    warm_up()
+    server = serve_health(jobs, args.port, args.host) if args.port else None
+    print(f'{datetime.utcnow()} - Daemon started with jobs: {", ".join(job["name"] for job in jobs)}')
+
+    while not stop_event.is_set():
+        job = min(jobs, key=lambda job: job['next_run'])
+        if stop_event.wait(max(0, job['next_run'] - time.monotonic())):
+            break
+        run_job(job, args.jitter)
+
+    for thread in workers:
+        thread.join()
+    if server:
+        server.shutdown()
+    print(f'{datetime.utcnow()} - Daemon stopped')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--accounts', nargs='+', help='Accounts to run the alert job for')
+    parser.add_argument('--story-account', help='Account to run the story job for')
+    parser.add_argument('--radar', action='store_true', help='Run the radar job')
+    parser.add_argument('--alerts-interval', type=float, default=60, help='Seconds between alert runs')
+    parser.add_argument('--radar-interval', type=float, default=300, help='Seconds between radar runs')
+    parser.add_argument('--story-interval', type=float, default=900, help='Seconds between story runs')
+    parser.add_argument('--jitter', type=float, default=5, help='Random seconds added to or removed from each interval')
+    parser.add_argument('--port', type=int, default=8080, help='Health endpoint port (0 disables it)')
+    parser.add_argument('--host', default=os.environ.get('HEALTH_HOST', '127.0.0.1'),
+                        help='Health endpoint address (0.0.0.0 for every interface)')
+    parser.add_argument('--outbox', action='store_true', help='Queue alerts in the outbox and post them from stage workers')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='Number of processes rendering alert maps')
+    main(parser.parse_args())
@@ -1,24 +1,107 @@
+import json
 import os
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from datetime import datetime
+from decimal import Decimal
+
 import boto3
 from botocore.exceptions import ClientError
 
-class Database:
+SQLITE_PATH = os.environ.get('SQLITE_PATH', 'social_weather.db')
+
+class Database(ABC):
+    '''
+    Interface shared by the state backends. Items are dictionaries keyed by
+    'id', with numbers returned as Decimal the way DynamoDB returns them.
+    Backends implement the abstract methods and can override the batch and
+    lookup helpers, which fall back to one call per item.
+    '''
+
+    @abstractmethod
+    def put(self, items):
+        raise NotImplementedError
+
+    def put_many(self, items):
+        for item in items:
+            self.put(item)
+
+    @abstractmethod
+    def put_if_absent(self, items):
+        raise NotImplementedError
+
+    @abstractmethod
+    def scan(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_all(self):
+        raise NotImplementedError
+
+    def get(self, id):
+        return next((item for item in self.scan() if item['id'] == id), None)
+
+    @abstractmethod
+    def delete(self, id):
+        raise NotImplementedError
+
+    def delete_many(self, ids):
+        for id in ids:
+            self.delete(id)
+
+class DynamoDatabase(Database):
     
     def __init__(self, table):
-        dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
+        # DYNAMODB_ENDPOINT_URL points at a local DynamoDB stand-in when set
+        dynamodb = boto3.resource('dynamodb', region_name='us-east-1',
+                                  endpoint_url=os.environ.get('DYNAMODB_ENDPOINT_URL'))
         self.table = dynamodb.Table(os.environ[table])
 
     def put(self, items):
         response = self.table.put_item(Item=items)
         return response
 
+    def put_many(self, items):
+        '''Writes items in batches of 25 per request, retrying unprocessed items'''
+        with self.table.batch_writer(overwrite_by_pkeys=['id']) as batch:
+            for item in items:
+                batch.put_item(Item=item)
+
+    def put_if_absent(self, items):
+        '''
+        Writes the item only if its id isn't stored yet. Returns True if this
+        call claimed the id and False if it already existed.
+        '''
+        try:
+            self.table.put_item(Item=items, ConditionExpression='attribute_not_exists(id)')
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+            raise
+        return True
+
+    def scan(self):
+        '''Yields every item in the table, following LastEvaluatedKey past the 1 MB page limit'''
+        kwargs = {}
+        while True:
+            response = self.table.scan(**kwargs)
+            yield from response['Items']
+
+            if 'LastEvaluatedKey' not in response:
+                return
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
     def get_all(self):
         try:
-            response = self.table.scan()
+            items = list(self.scan())
         except ClientError as e:
             print(e.response['Error']['Message'])
         else:
-            return response['Items']
+            return items
+
+    def get(self, id):
+        return self.table.get_item(Key={'id': id}).get('Item')
 
     def delete(self, id):
         try:
@@ -26,4 +109,124 @@ class Database:
         except ClientError as e:
             print(e.response['Error']['Message'])
         else:
-            return response
\ No newline at end of file
+            return response
+
+    def delete_many(self, ids):
+        '''Deletes items in batches of 25 per request'''
+        try:
+            with self.table.batch_writer(overwrite_by_pkeys=['id']) as batch:
+                for id in ids:
+                    batch.delete_item(Key={'id': id})
+        except ClientError as e:
+            print(e.response['Error']['Message'])
+
+def encode_number(number):
+    if isinstance(number, Decimal):
+        return int(number) if number == number.to_integral_value() else float(number)
+    raise TypeError(f'{type(number).__name__} is not JSON serializable')
+
+def expires_epoch(item):
+    '''Returns the item's expiration as seconds since the epoch, or None'''
+    if not item.get('expires'):
+        return None
+    return datetime.strptime(item['expires'], '%Y-%m-%dT%H:%M:%S%z').timestamp()
+
+class SQLiteDatabase(Database):
+    '''
+    Embedded backend storing each table in a local SQLite file in WAL mode,
+    with indexes on id and expires. When sync is set to another Database,
+    every write is also sent to it (i.e. write-through to DynamoDB).
+    '''
+
+    def __init__(self, table, path=SQLITE_PATH, sync=None):
+        self.name = os.environ.get(table, table).replace('"', '')
+        self.sync = sync
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            f'CREATE TABLE IF NOT EXISTS "{self.name}" (id TEXT PRIMARY KEY, expires REAL, item TEXT NOT NULL)')
+        self.connection.execute(
+            f'CREATE INDEX IF NOT EXISTS "{self.name}_expires" ON "{self.name}" (expires)')
+
+    def row(self, item):
+        return item['id'], expires_epoch(item), json.dumps(item, default=encode_number)
+
+    def load(self, text):
+        return json.loads(text, parse_float=Decimal, parse_int=Decimal)
+
+    def execute(self, sql, *params):
+        with self.lock:
+            return self.connection.execute(sql, params)
+
+    def put(self, items):
+        self.execute(f'INSERT OR REPLACE INTO "{self.name}" VALUES (?, ?, ?)', *self.row(items))
+        if self.sync:
+            self.sync.put(items)
+
+    def put_many(self, items):
+        items = list(items)
+        with self.lock:
+            with self.connection:
+                self.connection.execute('BEGIN')
+                self.connection.executemany(
+                    f'INSERT OR REPLACE INTO "{self.name}" VALUES (?, ?, ?)', [self.row(item) for item in items])
+        if self.sync:
+            self.sync.put_many(items)
+
+    def put_if_absent(self, items):
+        claimed = self.execute(f'INSERT OR IGNORE INTO "{self.name}" VALUES (?, ?, ?)', *self.row(items)).rowcount == 1
+        if claimed and self.sync:
+            self.sync.put(items)
+        return claimed
+
+    def scan(self):
+        rows = self.execute(f'SELECT item FROM "{self.name}" ORDER BY rowid').fetchall()
+        return (self.load(item) for item, in rows)
+
+    def get_all(self):
+        return list(self.scan())
+
+    def get(self, id):
+        row = self.execute(f'SELECT item FROM "{self.name}" WHERE id = ?', id).fetchone()
+        return self.load(row[0]) if row else None
+
+    def get_expired(self, now=None):
+        '''Returns items whose expires time has passed, using the expires index'''
+        now = now if now is not None else datetime.now().timestamp()
+        rows = self.execute(f'SELECT item FROM "{self.name}" WHERE expires <= ?', now).fetchall()
+        return [self.load(item) for item, in rows]
+
+    def delete(self, id):
+        self.execute(f'DELETE FROM "{self.name}" WHERE id = ?', id)
+        if self.sync:
+            self.sync.delete(id)
+
+    def delete_many(self, ids):
+        ids = list(ids)
+        with self.lock:
+            with self.connection:
+                self.connection.execute('BEGIN')
+                self.connection.executemany(f'DELETE FROM "{self.name}" WHERE id = ?', [(id,) for id in ids])
+        if self.sync:
+            self.sync.delete_many(ids)
+
+def open_database(table, config=None):
+    '''
+    Returns the Database for a table env var, using the backend named by the
+    account config's 'db_backend' ('dynamodb' or 'sqlite', default from the
+    DB_BACKEND env var). SQLite accounts can set 'db_path' and turn on
+    write-through to DynamoDB with 'db_sync'.
+    '''
+    config = config or {}
+    backend = config.get('db_backend', os.environ.get('DB_BACKEND', 'dynamodb'))
+
+    if backend == 'dynamodb':
+        return DynamoDatabase(table)
+
+    if backend == 'sqlite':
+        sync = DynamoDatabase(table) if config.get('db_sync') else None
+        return SQLiteDatabase(table, config.get('db_path', SQLITE_PATH), sync)
+
+    raise ValueError(f'Unknown database backend: {backend}')
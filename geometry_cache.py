@@ -0,0 +1,349 @@
+'''
+Compact, state-filtered cache of the UGC zone and county shapefiles
+
+The nationwide shapefiles are slow to read and mostly cover states none of
+our accounts post for. Running this module converts them into a small cache
+directory holding:
+
+    codes.npy       UGC code per shapefile row (i.e. FLZ050, FLC025)
+    latitudes.npy   LAT column
+    longitudes.npy  LON column
+    offsets.npy     start/end byte offsets of each row in geometries.wkb
+    geometries.wkb  concatenated WKB geometries
+    offsets_lod<n>.npy, geometries_lod<n>.wkb
+                    the same geometries simplified for each geometry_lod level
+
+Each build goes into its own generation directory (geometry_cache/<n>/),
+and meta.json, written last, names the current generation. It also records
+the states and the size and modification time of every source file. A
+reader memory-maps every file of one generation when it is created, so a
+rebuild never mixes old rows with new geometries. Old generations are
+removed after a rebuild. Processes that still map them keep their data
+until they reload. Geometries are only decoded when a UGC code is
+actually looked up.
+
+Loading a cache that misses one of the accounts' states, or that was built
+from other shapefiles, prints a warning. Rebuild it by running this module.
+
+Usage: python geometry_cache.py [--states FL SC] [--cache-dir geometry_cache]
+'''
+import argparse
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+from geometry_lod import LOD_LEVELS, simplify_geometry
+
+ZONE_SHAPEFILE = 'z_30mr21/z_30mr21.shp'
+COUNTY_SHAPEFILE = 'c_10nv20/c_10nv20.shp'
+CACHE_DIR = 'geometry_cache'
+
+# Shapefile parts read for the cache (geometries and attributes)
+SOURCE_EXTENSIONS = ('.shp', '.shx', '.dbf')
+
+def account_states(accounts=None):
+    '''Returns the states covered by the api_endpoint of the accounts (i.e. area=FL -> FL)'''
+    from accounts import creds
+
+    states = set()
+    for name, account in creds.items():
+        if accounts and name not in accounts:
+            continue
+        for param in account['api_endpoint'].split('&'):
+            key, _, value = param.partition('=')
+            if key == 'area':
+                states.update(value.split(','))
+
+    return sorted(states)
+
+def read_shapefiles(states=None):
+    '''Reads the zone and county shapefiles, optionally keeping only the given states'''
+    import geopandas
+
+    zones = geopandas.read_file(ZONE_SHAPEFILE)
+    counties = geopandas.read_file(COUNTY_SHAPEFILE)
+
+    if states:
+        zones = zones[zones['STATE'].isin(states)]
+        counties = counties[counties['STATE'].isin(states)]
+
+    return zones, counties
+
+def ugc_codes(zones, counties):
+    '''
+    Returns the UGC codes of each zone and county shapefile row
+
+    Zone codes are built from STATE_ZONE (i.e. FL050 -> FLZ050). County codes
+    are built from the state and the final three digits of the FIPS code
+    (i.e. FL and 12025 -> FLC025).
+    '''
+    zone_codes = zones['STATE_ZONE'].str[:2] + 'Z' + zones['STATE_ZONE'].str[2:]
+    county_codes = counties['STATE'] + 'C' + (counties['FIPS'].astype(int) % 1000).map('{:03d}'.format)
+
+    return zone_codes, county_codes
+
+def build_ugc_index(zones, counties):
+    '''
+    Maps every UGC code to its latitudes, longitudes and geometries so alerts
+    can be resolved without scanning the shapefiles. A code can span several
+    shapefile rows, so each entry holds lists.
+    '''
+    index = {}
+
+    for codes, gdf in zip(ugc_codes(zones, counties), (zones, counties)):
+        for code, lat, lon, geometry in zip(codes, gdf['LAT'], gdf['LON'], gdf['geometry']):
+            entry = index.setdefault(code, {'latitudes': [], 'longitudes': [], 'geometries': []})
+            entry['latitudes'].append(lat)
+            entry['longitudes'].append(lon)
+            entry['geometries'].append(geometry)
+
+    return index
+
+def source_fingerprints():
+    '''Returns [size, mtime] of every source shapefile part by path, or None for missing parts'''
+    fingerprints = {}
+    for shapefile in (ZONE_SHAPEFILE, COUNTY_SHAPEFILE):
+        for extension in SOURCE_EXTENSIONS:
+            path = os.path.splitext(shapefile)[0] + extension
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                fingerprints[path] = None
+            else:
+                fingerprints[path] = [stat.st_size, stat.st_mtime]
+    return fingerprints
+
+def write_geometries(cache_dir, suffix, blobs):
+    np.save(os.path.join(cache_dir, f'offsets{suffix}.npy'), np.cumsum([0] + [len(blob) for blob in blobs], dtype='int64'))
+
+    with open(os.path.join(cache_dir, f'geometries{suffix}.wkb'), 'wb') as f:
+        for blob in blobs:
+            f.write(blob)
+
+def generation_dir(cache_dir, meta):
+    '''Returns the directory holding the files of the generation meta.json names (the cache directory for old caches)'''
+    return os.path.join(cache_dir, str(meta['generation'])) if 'generation' in meta else cache_dir
+
+def write_cache(states, cache_dir=CACHE_DIR):
+    '''Converts the shapefiles for the given states into a new generation of the cache directory'''
+    zones, counties = read_shapefiles(states)
+    zone_codes, county_codes = ugc_codes(zones, counties)
+
+    codes = list(zone_codes) + list(county_codes)
+    latitudes = list(zones['LAT']) + list(counties['LAT'])
+    longitudes = list(zones['LON']) + list(counties['LON'])
+    geometries = list(zones['geometry']) + list(counties['geometry'])
+
+    generation = (read_meta(cache_dir) or {}).get('generation', 0) + 1
+    build_dir = os.path.join(cache_dir, f'{generation}.{os.getpid()}.tmp')
+    os.makedirs(build_dir)
+    np.save(os.path.join(build_dir, 'codes.npy'), np.array(codes, dtype='U6'))
+    np.save(os.path.join(build_dir, 'latitudes.npy'), np.array(latitudes, dtype='float64'))
+    np.save(os.path.join(build_dir, 'longitudes.npy'), np.array(longitudes, dtype='float64'))
+    write_geometries(build_dir, '', [geometry.wkb for geometry in geometries])
+
+    for level in range(len(LOD_LEVELS)):
+        write_geometries(build_dir, f'_lod{level}', [simplify_geometry(geometry, level).wkb for geometry in geometries])
+
+    os.rename(build_dir, os.path.join(cache_dir, str(generation)))
+
+    meta_path = os.path.join(cache_dir, 'meta.json')
+    temp_path = f'{meta_path}.{os.getpid()}.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump({'generation': generation, 'states': sorted(states), 'rows': len(codes),
+                   'sources': [ZONE_SHAPEFILE, COUNTY_SHAPEFILE], 'fingerprints': source_fingerprints()}, f)
+    os.replace(temp_path, meta_path)
+
+    for name in os.listdir(cache_dir):
+        if name.isdigit() and int(name) < generation:
+            shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
+
+    print(f'Cached {len(codes)} geometries for {", ".join(states)} in {cache_dir} (generation {generation})')
+
+class UGCIndex:
+    '''
+    UGC index over the dictionary returned by build_ugc_index. Simplified
+    geometries are computed on first use of each code and level.
+    '''
+
+    def __init__(self, index):
+        self.index = index
+        self.simplified = {}
+
+    def __contains__(self, code):
+        return code in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def get(self, code, default=None):
+        return self.index.get(code, default)
+
+    def centroids(self, code):
+        '''Returns the latitudes and longitudes of a code'''
+        entry = self.index[code]
+        return entry['latitudes'], entry['longitudes']
+
+    def geometries(self, code, level=None):
+        '''Returns a code's geometries, simplified for a geometry_lod level if given'''
+        if level is None:
+            return self.index[code]['geometries']
+
+        if (code, level) not in self.simplified:
+            self.simplified[(code, level)] = [simplify_geometry(geometry, level)
+                                              for geometry in self.index[code]['geometries']]
+        return self.simplified[(code, level)]
+
+class CachedUGCIndex:
+    '''
+    Read-only UGC index backed by one generation of the memory-mapped cache
+    directory, with the same methods as UGCIndex
+    '''
+
+    def __init__(self, cache_dir=CACHE_DIR):
+        meta = read_meta(cache_dir)
+        if meta is None:
+            raise FileNotFoundError(f'No geometry cache in {cache_dir}')
+        self.generation = meta.get('generation')
+        data_dir = generation_dir(cache_dir, meta)
+
+        # Map every file now: a later rebuild replaces the generation, and
+        # rows must always be read with the geometries they were built with
+        load = lambda name: np.load(os.path.join(data_dir, name), mmap_mode='r')
+        self.latitudes = load('latitudes.npy')
+        self.longitudes = load('longitudes.npy')
+
+        self.rows = {}
+        for row, code in enumerate(load('codes.npy').tolist()):
+            self.rows.setdefault(code, []).append(row)
+
+        self.blobs = {}
+        for suffix in [''] + [f'_lod{level}' for level in range(len(LOD_LEVELS))]:
+            if os.path.exists(os.path.join(data_dir, f'geometries{suffix}.wkb')):
+                self.blobs[suffix] = (
+                    load(f'offsets{suffix}.npy'),
+                    np.memmap(os.path.join(data_dir, f'geometries{suffix}.wkb'), dtype='uint8', mode='r'))
+        self.entries = {}
+
+    def __contains__(self, code):
+        return code in self.rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def geometry(self, row, suffix=''):
+        from shapely import wkb
+        offsets, blob = self.blobs[suffix]
+        return wkb.loads(blob[offsets[row]:offsets[row + 1]].tobytes())
+
+    def centroids(self, code):
+        rows = self.rows[code]
+        return [float(self.latitudes[row]) for row in rows], [float(self.longitudes[row]) for row in rows]
+
+    def geometries(self, code, level=None):
+        if level is None:
+            return self.get(code)['geometries']
+
+        if (code, level) not in self.entries:
+            if f'_lod{level}' in self.blobs:
+                geometries = [self.geometry(row, f'_lod{level}') for row in self.rows[code]]
+            else:
+                geometries = [simplify_geometry(geometry, level) for geometry in self.geometries(code)]
+            self.entries[(code, level)] = geometries
+
+        return self.entries[(code, level)]
+
+    def get(self, code, default=None):
+        if code not in self.rows:
+            return default
+
+        if code not in self.entries:
+            latitudes, longitudes = self.centroids(code)
+            self.entries[code] = {
+                'latitudes': latitudes,
+                'longitudes': longitudes,
+                'geometries': [self.geometry(row) for row in self.rows[code]]
+            }
+
+        return self.entries[code]
+
+def state_bounds(state):
+    '''Returns the (west, south, east, north) bounds of every zone and county in a state'''
+    index = load_ugc_index()
+    geometries = [geometry for code in index if code.startswith(state)
+                  for geometry in index.get(code)['geometries']]
+
+    if not geometries:
+        raise ValueError(f'No geometries found for {state}')
+
+    bounds = np.array([geometry.bounds for geometry in geometries])
+    return bounds[:, 0].min(), bounds[:, 1].min(), bounds[:, 2].max(), bounds[:, 3].max()
+
+def read_meta(cache_dir=CACHE_DIR):
+    try:
+        with open(os.path.join(cache_dir, 'meta.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def cache_fingerprint(cache_dir=CACHE_DIR):
+    '''Returns a digest of meta.json, which changes with every rebuild, or None if no cache was built'''
+    try:
+        with open(os.path.join(cache_dir, 'meta.json'), 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()[:16]
+    except OSError:
+        return None
+
+def is_cache_built(cache_dir=CACHE_DIR):
+    return read_meta(cache_dir) is not None
+
+def is_cache_current(meta, states):
+    '''
+    Whether the cache covers the states and was built from the shapefiles on
+    disk. A cache is kept as is when the shapefiles aren't there to rebuild it.
+    '''
+    fingerprints = source_fingerprints()
+    if None in fingerprints.values():
+        return True
+    return set(states) <= set(meta.get('states', [])) and meta.get('fingerprints') == fingerprints
+
+def requested_states():
+    '''Returns the accounts' states, or none if account credentials aren't configured (i.e. benchmarks)'''
+    try:
+        return account_states()
+    except KeyError:
+        return []
+
+def load_ugc_index(cache_dir=CACHE_DIR, states=None):
+    '''
+    Returns the cached UGC index, warning if it is stale or misses one of the
+    states (default: the accounts' states), and falling back to the full
+    shapefiles if no cache was built
+    '''
+    meta = read_meta(cache_dir)
+    if meta is None:
+        return UGCIndex(build_ugc_index(*read_shapefiles()))
+
+    states = states if states is not None else requested_states()
+    if not is_cache_current(meta, states):
+        print(f'Geometry cache in {cache_dir} is stale or misses some of {", ".join(states)}. '
+              'Rebuild it with: python geometry_cache.py')
+
+    # A rebuild can remove the generation named by the meta.json just read
+    for attempt in range(3):
+        try:
+            return CachedUGCIndex(cache_dir)
+        except FileNotFoundError:
+            if attempt == 2:
+                raise
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--states', nargs='+', help='States to keep (defaults to those in accounts.creds)')
+    parser.add_argument('--cache-dir', default=CACHE_DIR, help='Output directory')
+    args = parser.parse_args()
+
+    write_cache(args.states or account_states(), args.cache_dir)
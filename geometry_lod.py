@@ -0,0 +1,28 @@
+'''
+Level-of-detail buckets for drawing geometries at the scale of a map
+
+A 1280 pixel wide map spanning several degrees can't show detail finer than
+a fraction of a degree, so geometries are simplified (topology-preserving)
+with a tolerance of about half a pixel at the largest span of their bucket.
+The UGC county and zone levels are precomputed by geometry_cache.py.
+'''
+LOD_LEVELS = [
+    # (largest map span in degrees, simplification tolerance in degrees)
+    (2, 0.0008),
+    (5, 0.002),
+    (12, 0.005),
+    (float('inf'), 0.01),
+]
+
+def lod_level(extent):
+    '''Returns the level for a [west, east, south, north] map extent'''
+    west, east, south, north = extent
+    span = max(east - west, north - south)
+    return next(level for level, (max_span, _) in enumerate(LOD_LEVELS) if span <= max_span)
+
+def simplify_geometry(geometry, level):
+    return geometry.simplify(LOD_LEVELS[level][1], preserve_topology=True)
+
+def states_scale(level):
+    '''Natural Earth state border scale to draw at a level'''
+    return '10m' if level < 2 else '50m'
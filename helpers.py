@@ -1,17 +1,33 @@
 from datetime import datetime, timezone
 import pytz
 import time
-import numpy as np
 import requests
 
+import http_client
+
 def api_get(url):
-    response = requests.get(url, timeout=30, headers={"User-Agent": "curl/7.61.0"})
+    response = http_client.get(url)
     
     if response.status_code != 200:
-        raise requests.HTTPError(f'Error accessing {response.request.url}. Status code: {response.requests.status_code}')
+        raise requests.HTTPError(f'Error accessing {response.request.url}. Status code: {response.status_code}')
     
     return response.json()
 
+def api_get_if_modified(url, key):
+    '''
+    Like api_get, but returns None without parsing anything if the payload
+    hasn't changed since http_client.confirm_validators was last called for key
+    '''
+    response = http_client.conditional_get(url, key)
+
+    if response is None:
+        return None
+
+    if response.status_code != 200:
+        raise requests.HTTPError(f'Error accessing {response.request.url}. Status code: {response.status_code}')
+
+    return response.json()
+
 def convert_to_local(str):
     '''
     Takes in ISO8601 date and time and converts to 
@@ -29,6 +45,8 @@ def is_data_new_enough(datetime64, threshold_mins):
     Takes in a numpy datetime64 type and returns True if the current datetime
     is less than threshold_mins. Otherwise, it returns False.
     '''
+    import numpy as np
+
     data_time = datetime64
     current_time = np.datetime64(datetime.utcnow())
 
@@ -70,6 +88,8 @@ def iso8601_to_utc(iso8601):
 
 def datetime64_to_datetime(dt64):
     ''' Takes a numpy datetime64 type and converts to ISO8601'''
+    import numpy as np
+
     unix_epoch = np.datetime64(0, 's')
     one_second = np.timedelta64(1, 's')
     seconds_since_epoch = (dt64 - unix_epoch) / one_second
@@ -0,0 +1,114 @@
+'''
+Shared HTTP client with pooled keep-alive connections and conditional GETs
+
+conditional_get sends If-None-Match / If-Modified-Since using the ETag and
+Last-Modified last confirmed for a (key, url) pair and returns None on a
+304 Not Modified. Validators from a 200 response are only persisted once the
+caller has finished with the payload and calls confirm_validators, so a run
+that crashes midway re-fetches the same payload next time. Keys keep
+consumers of the same URL (i.e. two accounts polling area=FL) independent.
+The file is shared by every job, so confirming reloads it under a file lock
+and only merges in this process's key. forget_validators drops a URL's
+validators so its full payload is fetched again.
+'''
+import fcntl
+import json
+import os
+
+import requests
+from requests.adapters import HTTPAdapter
+
+HTTP_VALIDATORS_PATH = os.environ.get('HTTP_VALIDATORS_PATH', 'http_validators.json')
+
+session = requests.Session()
+session.headers.update({"User-Agent": "curl/7.61.0"})
+session.mount('https://', HTTPAdapter(pool_connections=10, pool_maxsize=20))
+session.mount('http://', HTTPAdapter(pool_connections=10, pool_maxsize=20))
+
+validators = None
+pending_validators = {}
+
+def get(url, timeout=30, **kwargs):
+    return session.get(url, timeout=timeout, **kwargs)
+
+def read_validators():
+    try:
+        with open(HTTP_VALIDATORS_PATH) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def load_validators():
+    global validators
+
+    if validators is None:
+        validators = read_validators()
+
+    return validators
+
+def validator_key(url, key):
+    return f'{key} {url}'
+
+def conditional_get(url, key='default', timeout=30, **kwargs):
+    '''Returns the response, or None if the resource hasn't changed for this key'''
+    saved = load_validators().get(validator_key(url, key), {})
+    headers = dict(kwargs.pop('headers', {}))
+
+    if saved.get('etag'):
+        headers['If-None-Match'] = saved['etag']
+    if saved.get('last_modified'):
+        headers['If-Modified-Since'] = saved['last_modified']
+
+    response = get(url, timeout=timeout, headers=headers, **kwargs)
+
+    if response.status_code == 304:
+        return None
+
+    if response.status_code == 200:
+        pending_validators[validator_key(url, key)] = {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified')
+        }
+
+    return response
+
+def update_validators(change):
+    '''
+    Applies change to the validators file under a lock, reloading it first
+    so keys other processes confirmed since our load aren't overwritten
+    '''
+    global validators
+
+    with open(f'{HTTP_VALIDATORS_PATH}.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        validators = read_validators()
+        change(validators)
+
+        temp_path = f'{HTTP_VALIDATORS_PATH}.{os.getpid()}.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(validators, f)
+        os.replace(temp_path, HTTP_VALIDATORS_PATH)
+
+def confirm_validators(url, key='default'):
+    '''Persists the validators of the last 200 response once its payload was processed'''
+    pending = pending_validators.pop(validator_key(url, key), None)
+
+    if pending is not None:
+        update_validators(lambda saved: saved.update({validator_key(url, key): pending}))
+
+def forget_validators(url):
+    '''
+    Drops the validators of every key for a URL, so the next conditional_get
+    fetches the full payload again (i.e. after alerts from it were released)
+    '''
+    def is_for_url(saved_key):
+        return saved_key.endswith(f' {url}')
+
+    for pending_key in list(filter(is_for_url, pending_validators)):
+        del pending_validators[pending_key]
+
+    def forget(saved):
+        for saved_key in list(filter(is_for_url, saved)):
+            del saved[saved_key]
+
+    update_validators(forget)
@@ -0,0 +1,62 @@
+'''
+Encodes rendered figures straight from the Agg canvas buffer
+
+The map is drawn once into the canvas and the RGBA buffer is handed to PIL,
+instead of savefig re-rendering and encoding a full-colour PNG. IMAGE_FORMAT
+picks the output:
+
+    png    full-colour PNG, fast zlib level
+    png8   256-colour palette PNG (the maps are flat fills, lines and text)
+    jpeg   quality 82 without chroma subsampling so thin red lines stay red
+    webp   quality 80 with a fast compression method
+
+Settings favour encode speed at a size close to the format's best. Compare
+formats on rendered fixtures with benchmarks/bench_encode.py.
+'''
+import io
+import os
+
+import numpy as np
+from PIL import Image
+
+IMAGE_FORMAT = os.environ.get('IMAGE_FORMAT', 'png')
+
+EXTENSIONS = {'png': 'png', 'png8': 'png', 'jpeg': 'jpg', 'webp': 'webp'}
+
+def canvas_rgba(fig):
+    '''Draws the figure and returns its pixels as an RGBA array'''
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    canvas = FigureCanvasAgg(fig)
+    canvas.draw()
+    return np.asarray(canvas.buffer_rgba())
+
+def canvas_rgb(fig):
+    '''Draws the figure and returns its pixels as an RGB array'''
+    return canvas_rgba(fig)[..., :3]
+
+def encode_rgb(pixels, image_format=None):
+    '''Encodes an RGB array in one of the EXTENSIONS formats and returns the bytes'''
+    image_format = image_format or IMAGE_FORMAT
+    image = Image.fromarray(np.ascontiguousarray(pixels))
+    buffer = io.BytesIO()
+
+    if image_format == 'png':
+        image.save(buffer, format='PNG', compress_level=3)
+    elif image_format == 'png8':
+        image.quantize(256, method=Image.Quantize.FASTOCTREE, dither=Image.Dither.NONE).save(buffer, format='PNG', compress_level=6)
+    elif image_format == 'jpeg':
+        image.save(buffer, format='JPEG', quality=82, subsampling=0)
+    elif image_format == 'webp':
+        image.save(buffer, format='WEBP', quality=80, method=2)
+    else:
+        raise ValueError(f'Unknown image format {image_format}. Choose from {", ".join(EXTENSIONS)}')
+
+    return buffer.getvalue()
+
+def encode_figure(fig, image_format=None):
+    return encode_rgb(canvas_rgb(fig), image_format)
+
+def image_filename(name='alert_visual', image_format=None):
+    '''Returns a filename whose extension matches the format, which is how Twitter picks the media type'''
+    return f'{name}.{EXTENSIONS[image_format or IMAGE_FORMAT]}'
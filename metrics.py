@@ -0,0 +1,198 @@
+'''
+Timing spans, counters and observations for the alert, radar and story jobs
+
+Set METRICS to enable:
+
+    METRICS=json        append one JSON record per run to METRICS_PATH
+                        (default metrics.jsonl)
+    METRICS=prometheus  rewrite the job's textfile after every run in the
+                        Prometheus textfile format, for node_exporter's
+                        textfile collector: social_weather_<job>.prom in
+                        METRICS_DIR, or METRICS_PATH with _<job> added
+                        before its extension
+
+Each run is collected on its own, so jobs running in separate threads (such
+as the outbox stage workers) don't mix their numbers. Anything recorded
+outside a run is dropped. With METRICS unset, timed() returns the function unchanged and span(),
+count() and observe() return immediately, so instrumentation costs a
+function call at most.
+
+    with metrics.run('alerts'):
+        with metrics.span('nws_fetch'):
+            ...
+        metrics.count('alerts_new', len(new_alerts))
+        metrics.observe('alert_post_latency_seconds', latency)
+'''
+import contextvars
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from functools import wraps
+
+METRICS = os.environ.get('METRICS', '')
+METRICS_PATH = os.environ.get('METRICS_PATH')
+METRICS_DIR = os.environ.get('METRICS_DIR', '.')
+ENABLED = METRICS in ('json', 'prometheus')
+
+PROMETHEUS_PREFIX = 'social_weather'
+
+lock = threading.Lock()
+
+class Run:
+    '''Everything recorded during one run of a job'''
+
+    def __init__(self, job):
+        self.job = job
+        self.started = datetime.utcnow().isoformat()
+        self.start_time = time.time()
+        self.spans = {}
+        self.counters = {}
+        self.observations = {}
+
+    def is_empty(self):
+        return not (self.spans or self.counters or self.observations)
+
+# The run being recorded. Each thread starts outside any run, while asyncio
+# tasks and asyncio.to_thread calls share the run of the code that started them
+active = contextvars.ContextVar('metrics_run', default=None)
+
+def record_span(name, seconds):
+    current = active.get()
+    if current is None:
+        return
+    with lock:
+        span = current.spans.setdefault(name, {'count': 0, 'seconds': 0.0, 'max': 0.0})
+        span['count'] += 1
+        span['seconds'] += seconds
+        span['max'] = max(span['max'], seconds)
+
+@contextmanager
+def timed_span(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, time.perf_counter() - start)
+
+def span(name):
+    '''Context manager timing a stage. Repeated spans with one name are summed'''
+    return timed_span(name) if ENABLED else nullcontext()
+
+def timed(name):
+    '''Decorator timing every call of a function as a span'''
+    def decorator(func):
+        if not ENABLED:
+            return func
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with timed_span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def count(name, value=1):
+    current = active.get() if ENABLED else None
+    if current is None:
+        return
+    with lock:
+        current.counters[name] = current.counters.get(name, 0) + value
+
+def observe(name, value):
+    '''Records one value of a distribution, such as a single alert's post latency'''
+    current = active.get() if ENABLED else None
+    if current is None:
+        return
+    with lock:
+        current.observations.setdefault(name, []).append(value)
+
+def summary(values):
+    return {'count': len(values), 'sum': sum(values), 'min': min(values), 'max': max(values)}
+
+def run_record(current):
+    return {
+        'job': current.job,
+        'started': current.started,
+        'duration': time.time() - current.start_time,
+        'spans': current.spans,
+        'counters': current.counters,
+        'observations': {name: summary(values) for name, values in current.observations.items()}
+    }
+
+def write_json(record):
+    line = json.dumps(record) + '\n'
+    with lock:
+        with open(METRICS_PATH or 'metrics.jsonl', 'a') as f:
+            f.write(line)
+
+def prometheus_lines(record):
+    labels = f'job="{record["job"]}"'
+    lines = [f'{PROMETHEUS_PREFIX}_run_duration_seconds{{{labels}}} {record["duration"]}',
+             f'{PROMETHEUS_PREFIX}_run_success{{{labels}}} {int(record["success"])}',
+             f'{PROMETHEUS_PREFIX}_run_timestamp_seconds{{{labels}}} {time.time()}']
+
+    for name, stats in record['spans'].items():
+        span_labels = f'{labels},span="{name}"'
+        lines.append(f'{PROMETHEUS_PREFIX}_span_seconds_sum{{{span_labels}}} {stats["seconds"]}')
+        lines.append(f'{PROMETHEUS_PREFIX}_span_seconds_count{{{span_labels}}} {stats["count"]}')
+        lines.append(f'{PROMETHEUS_PREFIX}_span_seconds_max{{{span_labels}}} {stats["max"]}')
+
+    for name, value in record['counters'].items():
+        lines.append(f'{PROMETHEUS_PREFIX}_{name}{{{labels}}} {value}')
+
+    for name, stats in record['observations'].items():
+        for key in ('sum', 'count', 'max'):
+            lines.append(f'{PROMETHEUS_PREFIX}_{name}_{key}{{{labels}}} {stats[key]}')
+
+    return lines
+
+def prometheus_path(job):
+    '''Returns the job's textfile. Every job gets its own, so jobs never overwrite each other's metrics'''
+    if METRICS_PATH:
+        root, extension = os.path.splitext(METRICS_PATH)
+        return f'{root}_{job}{extension or ".prom"}'
+    return os.path.join(METRICS_DIR, f'{PROMETHEUS_PREFIX}_{job}.prom')
+
+def write_prometheus(record):
+    '''Rewrites the job's textfile atomically so the collector never reads a partial file'''
+    path = prometheus_path(record['job'])
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    with open(temp_path, 'w') as f:
+        f.write('\n'.join(prometheus_lines(record)) + '\n')
+    os.replace(temp_path, path)
+
+@contextmanager
+def run(job, emit_empty=True):
+    '''
+    Collects everything recorded during one run of a job, in this thread and
+    the tasks it starts, and emits it when the run ends. Runs in other
+    threads are collected separately, and a nested run replaces the outer
+    one until it ends. With emit_empty=False a run that recorded nothing is
+    not emitted, e.g. an idle pass of a polling loop.
+    '''
+    if not ENABLED:
+        yield
+        return
+
+    current = Run(job)
+    token = active.set(current)
+    success = False
+    try:
+        yield
+        success = True
+    finally:
+        active.reset(token)
+        if emit_empty or not success or not current.is_empty():
+            emit(current, success)
+
+def emit(current, success):
+    with lock:
+        record = {**run_record(current), 'success': success}
+
+    try:
+        write_prometheus(record) if METRICS == 'prometheus' else write_json(record)
+    except OSError as e:
+        print(f'Unable to write metrics: {e}')
@@ -0,0 +1,389 @@
+'''
+Durable outbox between alert detection and posting
+
+Detection only claims alerts and queues them here. Separate workers then move
+each (account, alert) row through
+
+    pending -> detected -> rendered -> uploaded -> posted
+
+with failed and expired as the other final states. Every stage can be
+repeated safely, so a failure is retried with backoff and a crash or restart
+resumes each row from its last stage. A slow render, upload or post never
+holds up the next poll. Rows live in a SQLite file in WAL mode (OUTBOX_PATH),
+with the rendered map (and the local overlay blended into it, if any) and
+the image to post stored in the row until it is posted. Cloudinary uploads
+of finished rows are cleaned up together once no other upload is in flight.
+
+Detection queues an alert as pending before claiming it in the account's
+database. The workers ignore pending rows. A row moves on to detected once
+the claim succeeds and is dropped if another runner claimed the alert first.
+A crash between the two steps leaves the row pending, and the next poll
+claims it again. Claims carry the outbox's runner id, so a claim that
+landed just before the crash is recognised as this runner's own. Twitter
+rejects an exact duplicate status, so a post that went out just before a
+crash counts as posted when it is retried. SIGTERM or Ctrl-C lets every
+stage finish its current pass before the process exits.
+
+Usage: python outbox.py --accounts florida_storms ray_hawthorne [--once] [-w 2]
+'''
+import argparse
+import json
+import os
+import random
+import signal
+import socket
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+import metrics
+from accounts import creds
+from auto_tweet import (get_alerts, get_database, retrieve_new_alerts, find_tweetable_alerts, alert_record,
+                        alerts_url, render_alert_maps, overlay_key, alert_media, alert_message, issued_at,
+                        cleanup_uploads)
+from helpers import is_alert_active
+from http_client import confirm_validators
+
+OUTBOX_PATH = os.environ.get('OUTBOX_PATH', 'outbox.db')
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', 6))
+OUTBOX_RETRY_SECONDS = float(os.environ.get('OUTBOX_RETRY_SECONDS', 15))
+OUTBOX_KEEP_DAYS = float(os.environ.get('OUTBOX_KEEP_DAYS', 2))
+
+FINAL_STATES = ('posted', 'failed', 'expired')
+
+# Twitter's "Status is a duplicate" error code
+DUPLICATE_STATUS = 187
+
+def dump_overlay(overlay):
+    return json.dumps(overlay) if overlay is not None else None
+
+def load_overlay(text):
+    '''Turns a stored overlay back into the (event, logo_filename) tuple used as an image key'''
+    return tuple(json.loads(text)) if text else None
+
+class Outbox:
+
+    def __init__(self, path=OUTBOX_PATH):
+        self.runner = f'{socket.gethostname()}:{os.path.abspath(path)}'
+        self.lock = threading.Lock()
+        # Held while uploading and while cleaning up, so a cleanup never deletes an upload that is still in flight
+        self.uploads_lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS outbox ('
+            'account TEXT NOT NULL, alert_id TEXT NOT NULL, state TEXT NOT NULL, alert TEXT NOT NULL, '
+            'image BLOB, overlay TEXT, post_image BLOB, media TEXT, attempts INTEGER NOT NULL DEFAULT 0, next_attempt REAL NOT NULL, '
+            'last_error TEXT, created REAL NOT NULL, updated REAL NOT NULL, '
+            'PRIMARY KEY (account, alert_id))')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS outbox_due ON outbox (state, next_attempt)')
+
+    def execute(self, sql, *params):
+        with self.lock:
+            return self.connection.execute(sql, params)
+
+    def enqueue(self, account, alert):
+        '''Queues an alert for an account as pending, returning False if it was already queued'''
+        now = time.time()
+        return self.execute(
+            'INSERT OR IGNORE INTO outbox (account, alert_id, state, alert, next_attempt, created, updated) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            account, alert['properties']['id'], 'pending', json.dumps(alert), now, now, now).rowcount == 1
+
+    def promote(self, account, alert_id):
+        '''Hands a pending alert to the workers once its claim succeeded'''
+        self.execute('UPDATE outbox SET state = ?, next_attempt = ?, updated = ? '
+                     'WHERE account = ? AND alert_id = ? AND state = ?',
+                     'detected', time.time(), time.time(), account, alert_id, 'pending')
+
+    def discard(self, account, alert_id):
+        '''Drops a pending alert that another runner claimed'''
+        self.execute('DELETE FROM outbox WHERE account = ? AND alert_id = ? AND state = ?',
+                     account, alert_id, 'pending')
+
+    def pending(self, account):
+        '''Returns the account's alerts left pending by a crash between queueing and claiming'''
+        rows = self.execute('SELECT alert FROM outbox WHERE account = ? AND state = ? ORDER BY created',
+                            account, 'pending').fetchall()
+        return [json.loads(alert) for alert, in rows]
+
+    def due(self, state, limit=20):
+        rows = self.execute(
+            'SELECT account, alert_id, alert, image, overlay, post_image, media, attempts FROM outbox '
+            'WHERE state = ? AND next_attempt <= ? ORDER BY created LIMIT ?', state, time.time(), limit).fetchall()
+        return [{'account': account, 'alert_id': alert_id, 'alert': json.loads(alert), 'image': image,
+                 'overlay': load_overlay(overlay), 'post_image': post_image, 'media': media, 'attempts': attempts}
+                for account, alert_id, alert, image, overlay, post_image, media, attempts in rows]
+
+    def advance(self, row, state, **columns):
+        '''Moves a row to a state, resetting its retry count, and stores any new columns'''
+        assignments = ''.join(f', {column} = ?' for column in columns)
+        self.execute(
+            f'UPDATE outbox SET state = ?, attempts = 0, last_error = NULL, next_attempt = ?, updated = ?{assignments} '
+            'WHERE account = ? AND alert_id = ?',
+            state, time.time(), time.time(), *columns.values(), row['account'], row['alert_id'])
+
+    def retry(self, row, error):
+        '''Schedules another attempt with jittered exponential backoff, or gives up'''
+        attempts = row['attempts'] + 1
+        if attempts >= OUTBOX_MAX_ATTEMPTS:
+            print(f"Giving up on {row['alert_id']} for {row['account']}: {error}")
+            metrics.count('outbox_failed')
+            self.execute('UPDATE outbox SET state = ?, attempts = ?, last_error = ?, updated = ? '
+                         'WHERE account = ? AND alert_id = ?',
+                         'failed', attempts, repr(error), time.time(), row['account'], row['alert_id'])
+            return
+
+        delay = random.uniform(0.5, 1.5) * OUTBOX_RETRY_SECONDS * 2 ** row['attempts']
+        self.execute('UPDATE outbox SET attempts = ?, last_error = ?, next_attempt = ?, updated = ? '
+                     'WHERE account = ? AND alert_id = ?',
+                     attempts, repr(error), time.time() + delay, time.time(), row['account'], row['alert_id'])
+
+    def rendered_image(self, alert_id, overlay):
+        '''Returns a map already rendered for this alert and overlay by another account's row'''
+        row = self.execute('SELECT image FROM outbox WHERE alert_id = ? AND overlay IS ? AND image IS NOT NULL LIMIT 1',
+                           alert_id, dump_overlay(overlay)).fetchone()
+        return row[0] if row else None
+
+    def pending_uploads(self):
+        '''Counts rows that are being uploaded or whose uploaded media hasn't been posted yet'''
+        return self.execute('SELECT COUNT(*) FROM outbox WHERE state = ? OR (state = ? AND media IS NOT NULL)',
+                            'rendered', 'uploaded').fetchone()[0]
+
+    def uncleaned_media(self):
+        '''Returns the Cloudinary media of finished rows that hasn't been cleaned up yet'''
+        rows = self.execute(f'SELECT media FROM outbox WHERE state IN ({",".join("?" * len(FINAL_STATES))}) '
+                            'AND media IS NOT NULL', *FINAL_STATES).fetchall()
+        return [{'media': media} for media, in rows]
+
+    def mark_cleaned(self):
+        self.execute(f'UPDATE outbox SET media = NULL WHERE state IN ({",".join("?" * len(FINAL_STATES))})',
+                     *FINAL_STATES)
+
+    def counts(self):
+        return dict(self.execute('SELECT state, COUNT(*) FROM outbox GROUP BY state').fetchall())
+
+    def purge(self):
+        '''Deletes finished rows older than OUTBOX_KEEP_DAYS'''
+        cutoff = time.time() - OUTBOX_KEEP_DAYS * 24 * 60 * 60
+        self.execute(f'DELETE FROM outbox WHERE state IN ({",".join("?" * len(FINAL_STATES))}) AND updated < ?',
+                     *FINAL_STATES, cutoff)
+
+def reclaim_pending(outbox, account):
+    '''Finishes the claims of pending rows, keeping the ones this runner already claimed before a crash'''
+    dynamo = get_database(account)
+    for alert in outbox.pending(account):
+        alert_id = alert['properties']['id']
+        claimed = is_alert_active(alert['properties']['expires']) and (
+            dynamo.put_if_absent(alert_record(alert, outbox.runner))
+            or (dynamo.get(alert_id) or {}).get('claimed_by') == outbox.runner)
+        if claimed:
+            outbox.promote(account, alert_id)
+        else:
+            outbox.discard(account, alert_id)
+
+def detect_alerts(outbox, accounts):
+    '''
+    Polls each NWS endpoint once, queues every account's new tweetable alerts
+    and claims them in the account's database. Returns the number queued.
+    '''
+    endpoints = {}
+    for account in accounts:
+        endpoints.setdefault(creds[account]['api_endpoint'], []).append(account)
+
+    queued = 0
+    for endpoint, endpoint_accounts in endpoints.items():
+        for account in endpoint_accounts:
+            reclaim_pending(outbox, account)
+
+        key = ','.join(endpoint_accounts)
+        alerts = get_alerts(endpoint, key)
+        if alerts is None:
+            continue
+
+        for account in endpoint_accounts:
+            queued_ids = []
+
+            def queue(candidates):
+                queued_ids.extend(alert['properties']['id'] for alert in find_tweetable_alerts(candidates)
+                                  if outbox.enqueue(account, alert))
+
+            claimed_ids = {alert['properties']['id'] for alert in
+                           retrieve_new_alerts(account, alerts, queue, outbox.runner)}
+            for alert_id in queued_ids:
+                if alert_id in claimed_ids:
+                    outbox.promote(account, alert_id)
+                else:
+                    outbox.discard(account, alert_id)
+            queued += len(claimed_ids.intersection(queued_ids))
+
+        confirm_validators(alerts_url(endpoint), key)
+
+    return queued
+
+def poll(outbox, accounts):
+    '''One detection pass, plus housekeeping'''
+    detect_alerts(outbox, accounts)
+    outbox.purge()
+    print(f'{datetime.utcnow()} - Outbox: {outbox.counts()}')
+
+def expire_if_stale(outbox, row):
+    '''Stops work on alerts that expired while they were queued'''
+    if is_alert_active(row['alert']['properties']['expires']):
+        return False
+    outbox.advance(row, 'expired')
+    return True
+
+def render_stage(outbox, workers=1):
+    '''Renders every due detected row, once per alert across accounts'''
+    rows = [row for row in outbox.due('detected') if not expire_if_stale(outbox, row)]
+    for row in rows:
+        row['overlay'] = overlay_key(row['alert'], row['account'])
+    images = {(row['alert_id'], row['overlay']): outbox.rendered_image(row['alert_id'], row['overlay']) for row in rows}
+
+    missing = {}
+    for (alert_id, overlay), image in images.items():
+        if image is None:
+            missing.setdefault(alert_id, set()).add(overlay)
+    if missing:
+        alerts = {row['alert_id']: row['alert'] for row in rows}
+        rendered = render_alert_maps([alerts[alert_id] for alert_id in missing], workers,
+                                     [list(overlays) for overlays in missing.values()])
+        for alert_id, variants in zip(missing, rendered):
+            for overlay in missing[alert_id]:
+                images[(alert_id, overlay)] = variants[overlay] if variants else None
+
+    for row in rows:
+        image = images[(row['alert_id'], row['overlay'])]
+        if image is not None:
+            outbox.advance(row, 'rendered', image=image, overlay=dump_overlay(row['overlay']))
+        elif row['attempts'] + 1 >= OUTBOX_MAX_ATTEMPTS:
+            # Post the text on its own rather than not at all
+            outbox.advance(row, 'rendered', overlay=dump_overlay(row['overlay']))
+        else:
+            outbox.retry(row, 'render failed')
+
+    return len(rows)
+
+def upload_stage(outbox):
+    '''Uploads maps to Cloudinary for rows whose overlay isn't applied locally'''
+    rows = outbox.due('rendered')
+
+    for row in rows:
+        if expire_if_stale(outbox, row):
+            continue
+        try:
+            with outbox.uploads_lock:
+                media = alert_media(row['alert'], row['image'], row['overlay'], row['account'])
+                outbox.advance(row, 'uploaded', post_image=media['image'], media=media['media'])
+        except Exception as e:
+            outbox.retry(row, e)
+
+    return len(rows)
+
+def is_duplicate_status(error):
+    return getattr(error, 'api_code', None) == DUPLICATE_STATUS
+
+def post_stage(outbox):
+    '''
+    Posts every due uploaded row. Each account's rows go out in issuance
+    order, or most urgent first when its rate limit can't cover them all
+    '''
+    from poster import post_message, posting_order
+
+    messages = [(row, alert_message(row['alert'], {'image': row['post_image'], 'media': row['media']}))
+                for row in outbox.due('uploaded') if not expire_if_stale(outbox, row)]
+
+    account_messages = {}
+    for row, message in sorted(messages, key=lambda item: issued_at(item[0]['alert'])):
+        account_messages.setdefault(row['account'], []).append((row, message))
+
+    for account, items in account_messages.items():
+        rows = {message['id']: row for row, message in items}
+        for message in posting_order([message for _, message in items], account):
+            row = rows[message['id']]
+            try:
+                post_message(message, account)
+            except Exception as e:
+                if not is_duplicate_status(e):
+                    outbox.retry(row, e)
+                    continue
+            outbox.advance(row, 'posted', image=None, post_image=None)
+
+    clean_uploads(outbox)
+    return len(messages)
+
+def clean_uploads(outbox):
+    '''
+    Cleans up the media of posted, failed and expired rows. Cloudinary cleanup
+    deletes every tagged upload, so it waits until no upload is in flight and
+    remembers the rows it still owes a cleanup in the meantime.
+    '''
+    with outbox.uploads_lock:
+        media = outbox.uncleaned_media()
+        if media and not outbox.pending_uploads():
+            cleanup_uploads(media)
+            outbox.mark_cleaned()
+
+def stage_loop(name, work, interval, stop_event):
+    '''Drains a stage whenever it has due rows, polling every interval otherwise'''
+    while not stop_event.is_set():
+        try:
+            with metrics.run(f'outbox_{name}', emit_empty=False):
+                busy = work()
+        except Exception as e:
+            print(f'Outbox {name} stage failed: {e}')
+            busy = 0
+        if not busy:
+            stop_event.wait(interval)
+
+def stages(outbox, workers=1):
+    return [('render', lambda: render_stage(outbox, workers)),
+            ('upload', lambda: upload_stage(outbox)),
+            ('post', lambda: post_stage(outbox))]
+
+def start_workers(outbox, stop_event, workers=1, interval=2):
+    '''Starts one thread per downstream stage and returns them. Join them after setting stop_event'''
+    threads = [threading.Thread(target=stage_loop, args=(name, work, interval, stop_event), daemon=True, name=name)
+               for name, work in stages(outbox, workers)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+def drain(outbox, workers=1):
+    '''Runs every stage in order once, for cron-style runs'''
+    for name, work in stages(outbox, workers):
+        with metrics.run(f'outbox_{name}'):
+            work()
+    outbox.purge()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--accounts', nargs='+', required=True, help='Accounts to detect and post alerts for')
+    parser.add_argument('--once', action='store_true', help='Detect once, drain every stage and exit')
+    parser.add_argument('--interval', type=float, default=30, help='Seconds between detection polls')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='Number of processes rendering alert maps')
+    args = parser.parse_args()
+
+    outbox = Outbox()
+    if args.once:
+        with metrics.run('outbox_detect'):
+            detect_alerts(outbox, args.accounts)
+        drain(outbox, max(1, args.workers))
+        print(f'{datetime.utcnow()} - Outbox: {outbox.counts()}')
+    else:
+        stop_event = threading.Event()
+        signal.signal(signal.SIGTERM, lambda *_: stop_event.set())
+        signal.signal(signal.SIGINT, lambda *_: stop_event.set())
+
+        threads = start_workers(outbox, stop_event, max(1, args.workers))
+        while not stop_event.is_set():
+            with metrics.run('outbox_detect'):
+                poll(outbox, args.accounts)
+            stop_event.wait(args.interval)
+
+        # Let an upload or post in progress finish rather than cutting it off
+        for thread in threads:
+            thread.join()
@@ -0,0 +1,250 @@
+'''
+Rate-limit-aware posting to Twitter
+
+One social.Twitter client is kept per account and every API call goes
+through a token bucket for its (account, endpoint). Buckets start from the
+documented limits and then follow the x-rate-limit-* headers of each
+response. Rate-limited (429) and server errors are retried with jittered
+exponential backoff, waiting for the bucket's reset time when the API gave
+one. A batch keeps its issuance order while the buckets can cover all of it.
+Otherwise it is posted most urgent first: tornado warnings, other warnings,
+watches, then statements and everything else. Messages that failed for a
+transient reason are returned to the caller to retry later. Permanent
+failures (i.e. a 403 or a broken media URL) are logged and dropped.
+
+Any object with tweepy.API's media_upload, update_status and last_response
+can stand in for the API, e.g. benchmarks/stand_in_twitter.py:
+
+    poster.apis['florida_storms'] = StandInAPI(limit=5, failure_rate=0.2)
+'''
+import io
+import os
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+
+import metrics
+
+# (requests per window, window seconds) until the API reports its own limits
+DEFAULT_LIMITS = {
+    'statuses/update': (300, 3 * 60 * 60),
+    'media/upload': (415, 15 * 60),
+}
+
+MAX_ATTEMPTS = int(os.environ.get('POST_MAX_ATTEMPTS', 5))
+BACKOFF_BASE = float(os.environ.get('POST_BACKOFF_BASE', 1))
+BACKOFF_MAX = float(os.environ.get('POST_BACKOFF_MAX', 60))
+
+# A message is held back rather than posted if its bucket can't free a
+# request within this many seconds
+MAX_WAIT = float(os.environ.get('POST_MAX_WAIT', 120))
+
+clients = {}
+apis = {}
+buckets = {}
+buckets_lock = threading.Lock()
+
+class TokenBucket:
+    '''Requests left for one account and endpoint, refilled continuously or at the API's reset time'''
+
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+        self.tokens = float(limit)
+        self.updated = time.monotonic()
+        self.reset_at = None
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        if self.reset_at is not None and time.time() >= self.reset_at:
+            self.tokens, self.reset_at = float(self.limit), None
+        elif self.reset_at is None:
+            self.tokens = min(self.limit, self.tokens + (now - self.updated) * self.limit / self.window)
+        self.updated = now
+
+    def wait_time(self):
+        '''Seconds until a request is available'''
+        with self.lock:
+            self.refill()
+            if self.tokens >= 1:
+                return 0
+            if self.reset_at is not None:
+                return max(0, self.reset_at - time.time())
+            return (1 - self.tokens) * self.window / self.limit
+
+    def available(self):
+        '''Requests that can be made right now'''
+        with self.lock:
+            self.refill()
+            return int(self.tokens)
+
+    def take(self):
+        with self.lock:
+            self.refill()
+            self.tokens -= 1
+
+    def update(self, headers):
+        '''Follows the API's view of the limit, if the response carried one'''
+        if not headers or 'x-rate-limit-remaining' not in headers:
+            return
+        with self.lock:
+            self.limit = int(headers.get('x-rate-limit-limit', self.limit))
+            self.tokens = float(headers['x-rate-limit-remaining'])
+            self.reset_at = float(headers['x-rate-limit-reset']) if 'x-rate-limit-reset' in headers else None
+            self.updated = time.monotonic()
+
+    def exhaust(self, retry_after=None):
+        with self.lock:
+            self.tokens = 0
+            if retry_after is not None:
+                self.reset_at = time.time() + retry_after
+
+def get_client(account):
+    '''Returns the account's social.Twitter client, creating it on first use'''
+    if account not in clients:
+        from social import Twitter
+        clients[account] = Twitter(account)
+    return clients[account]
+
+def get_api(account):
+    return apis[account] if account in apis else get_client(account).twitter_api()
+
+def get_bucket(account, endpoint):
+    with buckets_lock:
+        if (account, endpoint) not in buckets:
+            buckets[(account, endpoint)] = TokenBucket(*DEFAULT_LIMITS[endpoint])
+        return buckets[(account, endpoint)]
+
+def response_headers(response):
+    return {key.lower(): value for key, value in response.headers.items()} if response is not None else {}
+
+def error_status(error):
+    response = getattr(error, 'response', None)
+    return getattr(response, 'status_code', None)
+
+def is_retryable(status):
+    return status is None or status == 429 or status >= 500
+
+def backoff(attempt):
+    '''Full-jitter exponential backoff'''
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+class RateLimited(Exception):
+    '''Raised when a bucket can't free a request within MAX_WAIT'''
+
+def call(account, endpoint, method, *args, **kwargs):
+    '''Calls an API method within its bucket, retrying rate limits and server errors'''
+    bucket = get_bucket(account, endpoint)
+    api = get_api(account)
+
+    for attempt in range(MAX_ATTEMPTS):
+        wait = bucket.wait_time()
+        if wait > MAX_WAIT:
+            raise RateLimited(f'{endpoint} for {account} is rate limited for {wait:.0f}s')
+        time.sleep(wait)
+        bucket.take()
+
+        try:
+            result = getattr(api, method)(*args, **kwargs)
+        except Exception as e:
+            status = error_status(e)
+            headers = response_headers(getattr(e, 'response', None))
+            bucket.update(headers)
+            if not is_retryable(status) or attempt == MAX_ATTEMPTS - 1:
+                raise
+
+            metrics.count('post_retries')
+            if status == 429:
+                metrics.count('rate_limited')
+                bucket.exhaust(None if 'x-rate-limit-reset' in headers else backoff(attempt))
+            else:
+                time.sleep(backoff(attempt))
+            print(f'{endpoint} for {account} failed with status {status}, retrying')
+        else:
+            bucket.update(response_headers(getattr(api, 'last_response', None)))
+            return result
+
+def priority(message):
+    event = message.get('event') or ''
+    if event == 'Tornado Warning':
+        return 0
+    if event.endswith('Warning'):
+        return 1
+    if event.endswith('Watch'):
+        return 2
+    return 3
+
+def media_bytes(message):
+    '''Returns (filename, bytes) of the message image, downloading uploaded media'''
+    if message['image']:
+        from image_encoder import image_filename
+        return image_filename(), message['image']
+
+    import http_client
+    import requests
+    request = http_client.get(message['media'])
+    if request.status_code != 200:
+        raise requests.HTTPError(f"Error accessing {message['media']}. Status code: {request.status_code}",
+                                 response=request)
+    return os.path.basename(urlparse(message['media']).path) or 'temp.jpg', request.content
+
+def record_post_latency(message):
+    '''Records the time from NWS issuance to the post going out'''
+    if message.get('sent'):
+        latency = datetime.now(timezone.utc) - datetime.strptime(message['sent'], "%Y-%m-%dT%H:%M:%S%z")
+        metrics.observe('alert_post_latency_seconds', latency.total_seconds())
+
+def post_message(message, account):
+    '''Posts one message with its image, if any. Text-only posts get the account hashtag'''
+    text = message['message']
+
+    with metrics.span('twitter_post'):
+        if message['image'] or message['media']:
+            filename, data = media_bytes(message)
+            media = call(account, 'media/upload', 'media_upload', filename, file=io.BytesIO(data))
+            call(account, 'statuses/update', 'update_status', status=text[:280], media_ids=[media.media_id])
+        else:
+            call(account, 'statuses/update', 'update_status', f'{text[:270]} {get_client(account).get_hashtag}')
+
+    metrics.count('posts')
+    record_post_latency(message)
+
+def is_transient(error):
+    '''Whether a failed post may succeed later: rate limits, server errors and network errors'''
+    if isinstance(error, RateLimited):
+        return True
+    status = error_status(error)
+    return is_retryable(status) if status is not None else isinstance(error, OSError)
+
+def can_post_all(messages, account):
+    '''Whether the account's buckets have room for every message in the batch right now'''
+    uploads = sum(1 for message in messages if message['image'] or message['media'])
+    return (get_bucket(account, 'statuses/update').available() >= len(messages)
+            and get_bucket(account, 'media/upload').available() >= uploads)
+
+def posting_order(messages, account):
+    '''Returns the messages in the order given if the buckets can cover all of them, else most urgent first'''
+    return messages if can_post_all(messages, account) else sorted(messages, key=priority)
+
+def post_messages(messages, account):
+    '''
+    Posts messages in the order given, or most urgent first (issuance order
+    within each priority) when they compete for the rate limit. Returns the
+    messages that failed for a transient reason.
+    '''
+    unposted = []
+
+    for message in posting_order(messages, account):
+        try:
+            post_message(message, account)
+        except Exception as e:
+            print(f"Unable to post for {account}: {e}. Intended tweet: {message['message']}")
+            if is_transient(e):
+                unposted.append(message)
+            else:
+                metrics.count('posts_failed')
+
+    return unposted
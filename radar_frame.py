@@ -0,0 +1,140 @@
+'''
+Regional radar frames shared by every map rendered from the same radar scan
+
+The IEM n0q composite is requested once per scan (keyed by the `valid` time
+from the n0q JSON) for the whole region our accounts cover, directly in
+EPSG:4326 so it already matches the PlateCarree maps. The decoded RGBA raster
+is kept in memory and on disk, and each map crops its extent out of it.
+Frames from older scans are evicted as soon as a newer one is fetched.
+'''
+import io
+import os
+import time
+
+import numpy as np
+import requests
+from PIL import Image
+from cartopy import crs as ccrs
+
+import http_client
+
+RADAR_TIMESTAMP_URL = os.environ.get(
+    'RADAR_TIMESTAMP_URL', 'https://mesonet.agron.iastate.edu/data/gis/images/4326/USCOMP/n0q_0.json')
+RADAR_WMS_URL = os.environ.get('RADAR_WMS_URL', 'https://mesonet.agron.iastate.edu/cgi-bin/wms/nexrad/n0q-t.cgi?')
+RADAR_LAYER = 'nexrad-n0q-wmst'
+RADAR_FRAME_DIR = os.environ.get('RADAR_FRAME_DIR', 'radar_frames')
+
+# West, east, south and north bounds of the frame (FL and SC plus map margins)
+RADAR_REGION = (-92.0, -75.0, 23.0, 37.0)
+RADAR_RESOLUTION = 0.01
+
+# The n0q composite updates every 5 minutes
+TIMESTAMP_MAX_AGE = 60
+
+radar_timestamp = {'valid': None, 'checked': 0}
+radar_frames = {}
+
+def get_radar_timestamp():
+    '''Returns the valid time of the latest composite, checking IEM at most once a minute'''
+    if radar_timestamp['valid'] is None or time.time() - radar_timestamp['checked'] > TIMESTAMP_MAX_AGE:
+        f = http_client.get(RADAR_TIMESTAMP_URL).json()
+        radar_timestamp['valid'] = f['meta']['valid']
+        radar_timestamp['checked'] = time.time()
+
+    return radar_timestamp['valid']
+
+def frame_path(valid):
+    return os.path.join(RADAR_FRAME_DIR, f"n0q_{valid.replace(':', '')}.npy")
+
+def fetch_radar_frame(valid):
+    '''Downloads and decodes the regional composite for a valid time'''
+    west, east, south, north = RADAR_REGION
+    response = http_client.get(RADAR_WMS_URL, timeout=60, params={
+        'service': 'WMS',
+        'version': '1.1.1',
+        'request': 'GetMap',
+        'layers': RADAR_LAYER,
+        'styles': '',
+        'srs': 'EPSG:4326',
+        'bbox': f'{west},{south},{east},{north}',
+        'width': round((east - west) / RADAR_RESOLUTION),
+        'height': round((north - south) / RADAR_RESOLUTION),
+        'format': 'image/png',
+        'transparent': 'true',
+        'time': valid
+    })
+
+    if response.status_code != 200:
+        raise requests.HTTPError(f'Error accessing {response.url}. Status code: {response.status_code}')
+
+    return np.asarray(Image.open(io.BytesIO(response.content)).convert('RGBA'))
+
+def is_frame_file(name):
+    '''Whether a file is a completed frame, not another process's temporary file or anything else'''
+    return name.startswith('n0q_') and name.endswith('.npy') and not name.endswith('.tmp.npy')
+
+def evict_radar_frames(valid):
+    '''Drops frames from every scan other than the given one'''
+    for old_valid in [key for key in radar_frames if key != valid]:
+        del radar_frames[old_valid]
+
+    if os.path.isdir(RADAR_FRAME_DIR):
+        for name in os.listdir(RADAR_FRAME_DIR):
+            path = os.path.join(RADAR_FRAME_DIR, name)
+            if is_frame_file(name) and path != frame_path(valid):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    # Another process evicted it first
+                    pass
+
+def get_radar_frame():
+    '''Returns (valid time, RGBA frame) for the latest scan, fetching it at most once'''
+    valid = get_radar_timestamp()
+
+    if valid not in radar_frames:
+        path = frame_path(valid)
+
+        if os.path.exists(path):
+            frame = np.load(path, mmap_mode='r')
+        else:
+            frame = fetch_radar_frame(valid)
+            os.makedirs(RADAR_FRAME_DIR, exist_ok=True)
+            temp_path = f'{path}.{os.getpid()}.tmp.npy'
+            np.save(temp_path, frame)
+            os.replace(temp_path, path)
+
+        evict_radar_frames(valid)
+        radar_frames[valid] = frame
+
+    return valid, radar_frames[valid]
+
+def crop_radar_frame(frame, limits):
+    '''Returns the part of the frame covering the limits and the extent of that crop'''
+    west, east, south, north = RADAR_REGION
+    x0, x1, y0, y1 = limits
+    height, width = frame.shape[:2]
+
+    col0 = max(0, int(np.floor((x0 - west) / RADAR_RESOLUTION)))
+    col1 = min(width, int(np.ceil((x1 - west) / RADAR_RESOLUTION)))
+    row0 = max(0, int(np.floor((north - y1) / RADAR_RESOLUTION)))
+    row1 = min(height, int(np.ceil((north - y0) / RADAR_RESOLUTION)))
+
+    extent = (west + col0 * RADAR_RESOLUTION, west + col1 * RADAR_RESOLUTION,
+              north - row1 * RADAR_RESOLUTION, north - row0 * RADAR_RESOLUTION)
+    return frame[row0:row1, col0:col1], extent
+
+def add_radar(ax):
+    '''Draws the latest radar frame cropped to the axes limits'''
+    try:
+        _, frame = get_radar_frame()
+    except (requests.RequestException, ValueError, KeyError) as e:
+        print(f'Unable to retrieve radar frame: {e}')
+        return
+
+    ax.apply_aspect()
+    crop, extent = crop_radar_frame(frame, (*ax.get_xlim(), *ax.get_ylim()))
+
+    if crop.size:
+        ax.imshow(crop, extent=extent, origin='upper', transform=ccrs.PlateCarree(),
+                  interpolation='nearest', zorder=4, alpha=0.4)
@@ -0,0 +1,132 @@
+'''
+Vectorized evaluation of many lat/lon regions against a reflectivity grid
+
+Every region corner is projected in one transform_points call and turned
+into integer row/column windows, which are cached until the grid (its
+coordinates or projection) changes. Each evaluation then works on a local
+numpy array: pixel counts above the threshold come from a summed-area table
+and max reflectivity from a sparse table of row maxima, each built in a
+single pass for all regions, so adding regions adds microseconds rather
+than remote slices.
+'''
+import numpy as np
+import cartopy.crs as ccrs
+
+def grid_signature(x, y, crs):
+    return (len(x), float(x[0]), float(x[-1]), len(y), float(y[0]), float(y[-1]), crs.proj4_init)
+
+def coordinate_range(coords, low, high):
+    '''
+    Returns (start, stop) index arrays selecting coords between low and high
+    inclusive, for ascending or descending coordinates
+    '''
+    if coords[0] <= coords[-1]:
+        return np.searchsorted(coords, low, 'left'), np.searchsorted(coords, high, 'right')
+
+    reversed_coords = coords[::-1]
+    return (len(coords) - np.searchsorted(reversed_coords, high, 'right'),
+            len(coords) - np.searchsorted(reversed_coords, low, 'left'))
+
+def union_window(windows):
+    '''Returns the (row0, row1, col0, col1) window containing every region'''
+    return windows[:, 0].min(), windows[:, 1].max(), windows[:, 2].min(), windows[:, 3].max()
+
+def summed_area(mask):
+    table = np.zeros((mask.shape[0] + 1, mask.shape[1] + 1), dtype='int64')
+    np.cumsum(np.cumsum(mask, axis=0), axis=1, out=table[1:, 1:])
+    return table
+
+def row_max_table(values, max_width):
+    '''
+    Sparse table of maxima along rows: level k holds the max of the 2**k
+    columns starting at each column, so any column range is two lookups
+    '''
+    levels = max(1, int(max_width).bit_length())
+    table = np.empty((levels, *values.shape), dtype=values.dtype)
+    table[0] = values
+    for level in range(1, levels):
+        width = 1 << (level - 1)
+        table[level] = table[level - 1]
+        np.maximum(table[level - 1, :, :-width], table[level - 1, :, width:], out=table[level, :, :-width])
+    return table
+
+def window_max(values, windows):
+    '''Returns the max of values in each (row0, row1, col0, col1) window, with -inf for empty windows'''
+    result = np.full(len(windows), -np.inf)
+    row0, row1, col0, col1 = windows.T
+    heights, widths = row1 - row0, col1 - col0
+    filled = (heights > 0) & (widths > 0)
+    if not filled.any():
+        return result
+
+    # Only build the table over the windows' union
+    row0, heights, col0, widths = row0[filled], heights[filled], col0[filled], widths[filled]
+    top, left = row0.min(), col0.min()
+    values = values[top:(row0 + heights).max(), left:(col0 + widths).max()]
+    row0, col0 = row0 - top, col0 - left
+
+    table = row_max_table(values, widths.max())
+    levels = np.array([int(width).bit_length() - 1 for width in widths])
+
+    # One entry per window row, holding the max of the window's columns in that row
+    starts = np.cumsum(heights) - heights
+    rows = np.repeat(row0 - starts, heights) + np.arange(heights.sum())
+    row_levels = np.repeat(levels, heights)
+    row_max = np.maximum(table[row_levels, rows, np.repeat(col0, heights)],
+                         table[row_levels, rows, np.repeat(col0 + widths - (1 << levels), heights)])
+
+    result[filled] = np.maximum.reduceat(row_max, starts)
+    return result
+
+class RegionEngine:
+    '''
+    Evaluates a list of areas (dicts with 'coords' of [nw_lat, nw_lon, se_lat, se_lon])
+    against reflectivity grids
+    '''
+
+    def __init__(self, areas):
+        self.areas = areas
+        self.coords = np.array([area['coords'] for area in areas], dtype='float64')
+        self.signature = None
+        self.windows = None
+
+    def get_windows(self, x, y, crs):
+        '''
+        Returns an (areas, 4) array of row0, row1, col0, col1 grid indices per
+        area, selecting the same pixels as ds.metpy.sel over each bounding box
+        '''
+        signature = grid_signature(x, y, crs)
+
+        if signature != self.signature:
+            nw_lat, nw_lon, se_lat, se_lon = self.coords.T
+            points = crs.transform_points(ccrs.PlateCarree(),
+                                          np.concatenate([nw_lon, se_lon]), np.concatenate([nw_lat, se_lat]))
+            count = len(self.areas)
+            x_ul, x_lr = points[:count, 0], points[count:, 0]
+            y_ul, y_lr = points[:count, 1], points[count:, 1]
+
+            col0, col1 = coordinate_range(np.asarray(x), x_ul, x_lr)
+            row0, row1 = coordinate_range(np.asarray(y), y_lr, y_ul)
+
+            self.windows = np.stack([row0, row1, col0, col1], axis=1).astype('int64')
+            self.signature = signature
+
+        return self.windows
+
+    def evaluate(self, values, windows, threshold):
+        '''
+        Returns, per area, the max dBZ, the fraction of pixels at or above the
+        threshold and whether the threshold was reached. windows index values.
+        '''
+        row0, row1, col0, col1 = windows.T
+        filled_values = np.nan_to_num(values, nan=-np.inf)
+        table = summed_area(filled_values >= threshold)
+        above = table[row1, col1] - table[row0, col1] - table[row1, col0] + table[row0, col0]
+        pixels = np.maximum(row1 - row0, 0) * np.maximum(col1 - col0, 0)
+        fraction = np.divide(above, pixels, out=np.zeros(len(pixels)), where=pixels > 0)
+
+        # -inf where a window is empty or all NaN
+        max_dbz = [float(value) if np.isfinite(value) else None for value in window_max(filled_values, windows)]
+
+        return [{'max_dbz': max_dbz[idx], 'fraction': float(fraction[idx]), 'threshold_reached': bool(above[idx] > 0)}
+                for idx in range(len(windows))]
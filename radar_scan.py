@@ -0,0 +1,99 @@
+'''
+One regional read per radar scan, cached on disk by the scan's valid time
+
+Only the Florida/Southeast window of the national composite is read from
+THREDDS, in a single remote slice. The slice is saved under RADAR_CACHE_DIR
+keyed by the dataset's valid time, and every region, cell or zone is then
+evaluated from that local array. A processed marker records the last valid
+time handled so repeated runs on the same scan can exit immediately.
+'''
+import os
+
+import numpy as np
+import cartopy.crs as ccrs
+
+from radar_regions import coordinate_range, grid_signature
+
+RADAR_CACHE_DIR = os.environ.get('RADAR_CACHE_DIR', 'radar_cache')
+
+# West, east, south and north bounds of the regional subset
+SUBSET_REGION = (-92.0, -75.0, 24.0, 36.5)
+
+subset_windows = {}
+
+def scan_key(ds):
+    '''Returns the dataset valid time as a filename-safe string'''
+    return np.datetime_as_string(ds.time.values, unit='s').replace(':', '')
+
+def scan_path(key):
+    return os.path.join(RADAR_CACHE_DIR, f'scan_{key}.npz')
+
+def marker_path():
+    return os.path.join(RADAR_CACHE_DIR, 'processed')
+
+def is_scan_processed(key):
+    try:
+        with open(marker_path()) as f:
+            return f.read().strip() == key
+    except OSError:
+        return False
+
+def mark_scan_processed(key):
+    os.makedirs(RADAR_CACHE_DIR, exist_ok=True)
+    with open(marker_path(), 'w') as f:
+        f.write(key)
+
+def subset_window(x, y, crs):
+    '''Returns the (row0, row1, col0, col1) grid window covering SUBSET_REGION'''
+    signature = grid_signature(x, y, crs)
+
+    if signature not in subset_windows:
+        west, east, south, north = SUBSET_REGION
+        corners = crs.transform_points(ccrs.PlateCarree(), np.array([west, west, east, east]),
+                                       np.array([south, north, south, north]))
+        col0, col1 = coordinate_range(np.asarray(x), corners[:, 0].min(), corners[:, 0].max())
+        row0, row1 = coordinate_range(np.asarray(y), corners[:, 1].min(), corners[:, 1].max())
+        subset_windows.clear()
+        subset_windows[signature] = (int(row0), int(row1), int(col0), int(col1))
+
+    return subset_windows[signature]
+
+def is_scan_file(name):
+    '''Whether a file is a finished cached scan rather than another process's temporary file'''
+    return name.startswith('scan_') and name.endswith('.npz') and not name.endswith('.tmp.npz')
+
+def evict_scans(key):
+    '''Removes finished cached scans other than the given one'''
+    for name in os.listdir(RADAR_CACHE_DIR):
+        if is_scan_file(name) and name != os.path.basename(scan_path(key)):
+            try:
+                os.remove(os.path.join(RADAR_CACHE_DIR, name))
+            except FileNotFoundError:
+                # Another process evicted it first
+                pass
+
+def load_scan(ds, crs):
+    '''
+    Returns {'key', 'values', 'x', 'y', 'units'} for the regional subset of the scan,
+    reading it from THREDDS only if it isn't cached yet
+    '''
+    key = scan_key(ds)
+    path = scan_path(key)
+
+    if os.path.exists(path):
+        with np.load(path) as cached:
+            return {'key': key, 'values': cached['values'], 'x': cached['x'], 'y': cached['y'],
+                    'units': str(cached['units'])}
+
+    row0, row1, col0, col1 = subset_window(ds.x.values, ds.y.values, crs)
+    subset = ds.isel(y=slice(row0, row1), x=slice(col0, col1)).load()
+    scan = {'key': key, 'values': np.asarray(subset.values, dtype='float32'),
+            'x': subset.x.values, 'y': subset.y.values, 'units': subset.x.attrs.get('units', 'm')}
+
+    os.makedirs(RADAR_CACHE_DIR, exist_ok=True)
+    temp_path = f'{path}.{os.getpid()}.tmp.npz'
+    np.savez(temp_path, values=scan['values'], x=scan['x'], y=scan['y'], units=scan['units'])
+    os.replace(temp_path, path)
+    evict_scans(key)
+
+    return scan
@@ -0,0 +1,129 @@
+'''
+Per-county and per-zone radar statistics from a precomputed label raster
+
+The UGC county and zone polygons (from the geometry cache) are rasterized
+once onto the regional radar grid: every pixel gets the number of the
+county or zone containing its center. Alongside the raster we cache the
+pixel order that groups pixels by label, so each scan's max, mean and
+coverage for every county or zone are a handful of reduceat calls over the
+grid. Per-scan cost stays the same whether 12 or 3,000 areas are watched.
+Counties and zones overlap, so each gets its own raster. Rasters are keyed
+on the grid and the geometry cache's meta.json, so a cache rebuild with
+other states or shapefiles rasterizes again.
+'''
+import hashlib
+import os
+
+import numpy as np
+import cartopy.crs as ccrs
+
+from radar_regions import coordinate_range, grid_signature
+from radar_scan import RADAR_CACHE_DIR
+
+UGC_KINDS = {'counties': 'C', 'zones': 'Z'}
+
+label_rasters = {}
+
+def project_geometry(geometry, crs):
+    '''Transforms a lat/lon geometry into the grid projection'''
+    import shapely
+    source = ccrs.PlateCarree()
+    return shapely.transform(geometry, lambda coords: crs.transform_points(source, coords[:, 0], coords[:, 1])[:, :2])
+
+def rasterize(codes, index, x, y, crs):
+    '''Returns a label array with pixel values 1..len(codes) inside each code's geometries, 0 elsewhere'''
+    import shapely
+
+    x, y = np.asarray(x), np.asarray(y)
+    labels = np.zeros((len(y), len(x)), dtype='int32')
+
+    for label, code in enumerate(codes, start=1):
+        for geometry in index.get(code)['geometries']:
+            projected = project_geometry(geometry, crs)
+            west, south, east, north = projected.bounds
+            col0, col1 = coordinate_range(x, west, east)
+            row0, row1 = coordinate_range(y, south, north)
+            if row1 <= row0 or col1 <= col0:
+                continue
+
+            grid_x, grid_y = np.meshgrid(x[col0:col1], y[row0:row1])
+            inside = shapely.contains_xy(projected, grid_x, grid_y)
+            labels[row0:row1, col0:col1][inside] = label
+
+    return labels
+
+def build_label_raster(kind, x, y, crs):
+    '''Rasterizes one kind of UGC area and precomputes the label-sorted pixel order'''
+    from geometry_cache import load_ugc_index
+
+    index = load_ugc_index()
+    codes = sorted(code for code in index if code[2] == UGC_KINDS[kind])
+    labels = rasterize(codes, index, x, y, crs)
+
+    flat = labels.ravel()
+    order = np.argsort(flat, kind='stable')
+    order = order[flat[order] > 0]
+    present, starts = np.unique(flat[order], return_index=True)
+
+    return {'codes': np.array(codes), 'labels': labels, 'order': order, 'present': present, 'starts': starts}
+
+def raster_path(kind, signature):
+    digest = hashlib.sha1(repr(signature).encode()).hexdigest()[:16]
+    return os.path.join(RADAR_CACHE_DIR, f'labels_{kind}_{digest}.npz')
+
+def get_label_raster(kind, x, y, crs):
+    '''Returns the label raster for the grid, from memory, disk or a fresh rasterization'''
+    from geometry_cache import cache_fingerprint
+
+    signature = (grid_signature(x, y, crs), cache_fingerprint())
+    path = raster_path(kind, signature)
+
+    if (kind, signature) not in label_rasters:
+        if os.path.exists(path):
+            with np.load(path) as cached:
+                raster = {key: cached[key] for key in cached.files}
+        else:
+            raster = build_label_raster(kind, x, y, crs)
+            os.makedirs(RADAR_CACHE_DIR, exist_ok=True)
+            temp_path = f'{path}.{os.getpid()}.tmp.npz'
+            np.savez(temp_path, **raster)
+            os.replace(temp_path, path)
+
+        label_rasters[(kind, signature)] = raster
+
+    return label_rasters[(kind, signature)]
+
+def zonal_statistics(values, raster, threshold):
+    '''
+    Returns {code: {'max_dbz', 'mean_dbz', 'coverage', 'threshold_reached'}}
+    for every county or zone covering at least one pixel center. Mean is over
+    pixels with echoes; coverage is the fraction of pixels at or above the threshold.
+    '''
+    if not len(raster['order']):
+        return {}
+
+    grouped = values.ravel()[raster['order']]
+    echo = ~np.isnan(grouped)
+    starts = raster['starts']
+
+    pixels = np.diff(np.append(starts, len(grouped)))
+    echo_pixels = np.add.reduceat(echo, starts)
+    sums = np.add.reduceat(np.where(echo, grouped, 0), starts)
+    above = np.add.reduceat(np.nan_to_num(grouped, nan=-np.inf) >= threshold, starts)
+    maxes = np.maximum.reduceat(np.nan_to_num(grouped, nan=-np.inf), starts)
+
+    codes = raster['codes'][raster['present'] - 1]
+    return {str(code): {
+                'max_dbz': float(maxes[idx]) if echo_pixels[idx] else None,
+                'mean_dbz': float(sums[idx] / echo_pixels[idx]) if echo_pixels[idx] else None,
+                'coverage': float(above[idx] / pixels[idx]),
+                'threshold_reached': bool(above[idx])}
+            for idx, code in enumerate(codes)}
+
+def evaluate_ugc_areas(scan, crs, threshold, kinds=UGC_KINDS):
+    '''Returns zonal statistics of the scan for every county and zone, keyed by UGC code'''
+    statistics = {}
+    for kind in kinds:
+        raster = get_label_raster(kind, scan['x'], scan['y'], crs)
+        statistics.update(zonal_statistics(scan['values'], raster, threshold))
+    return statistics
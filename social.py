@@ -1,13 +1,18 @@
+import io
 import os
-import requests
+from urllib.parse import urlparse
+
 import tweepy
 
+import http_client
+
 from accounts import creds
 
 class Twitter:
 
     def __init__(self, account):
         self.account = account
+        self.api = None
 
     @property
     def get_hashtag(self):
@@ -19,11 +24,14 @@ class Twitter:
         return f"{url_prefix}{creds.get(self.account)['logo_filename']}"
 
     def twitter_api(self):
-        api_credentials = creds.get(self.account)
+        '''Returns the account's API client, building it on first use'''
+        if self.api is None:
+            api_credentials = creds.get(self.account)
 
-        auth = tweepy.OAuthHandler(api_credentials['consumer_key'], api_credentials['consumer_secret'])
-        auth.set_access_token(api_credentials['access_token'], api_credentials['access_token_secret'])
-        return tweepy.API(auth)
+            auth = tweepy.OAuthHandler(api_credentials['consumer_key'], api_credentials['consumer_secret'])
+            auth.set_access_token(api_credentials['access_token'], api_credentials['access_token_secret'])
+            self.api = tweepy.API(auth)
+        return self.api
 
     def tweet_text_only(self, message):
         message = f'{message[:270]} {self.get_hashtag}'
@@ -45,17 +53,18 @@ class Twitter:
         media = self.twitter_api().media_upload(filename)
         return media
 
+    def tweet_image_from_buffer(self, image, message, filename='alert_visual.png'):
+        ''' Uploads image bytes as media and tweets them. filename only sets the media type '''
+        api = self.twitter_api()
+        media = api.media_upload(filename, file=io.BytesIO(image))
+        api.update_status(status=message, media_ids=[media.media_id])
+
     def tweet_image_from_web(self, url, message):
-        filename = 'temp.jpg'
-        request = requests.get(url, stream=True, headers={"User-Agent": "curl/7.61.0"})
+        request = http_client.get(url)
         
         if request.status_code == 200:
-            with open(filename, 'wb') as image:
-                for chunk in request:
-                    image.write(chunk)
-
-            self.twitter_api().update_with_media(filename, status=message)
-            os.remove(filename)
+            filename = os.path.basename(urlparse(url).path) or 'temp.jpg'
+            self.tweet_image_from_buffer(request.content, message, filename)
         else:
             print('Unable to download image')
             
@@ -0,0 +1,150 @@
+'''
+Storm cell identification and tracking on the regional radar grid
+
+Once per scan the grid is thresholded and split into connected components
+(8-connected). Every cell's centroid, area, max dBZ and bounding box come
+from whole-grid bincount/ndimage reductions rather than per-cell loops.
+Cells are matched to the previous scan's cells by nearest centroid to
+estimate their motion. Cells are stored as a dict of equal-length arrays.
+'''
+import os
+
+import numpy as np
+from scipy import ndimage
+
+from radar_scan import RADAR_CACHE_DIR
+
+MIN_CELL_PIXELS = 4
+MAX_MATCH_DISTANCE_KM = 30
+
+# The composite updates every 5 minutes. Cells are only matched to the
+# previous scan's if it is at most this old, since after a longer gap
+# (missed runs, a restart) nearest-centroid matches are mostly coincidence
+MAX_TRACK_GAP_SECONDS = float(os.environ.get('MAX_TRACK_GAP_SECONDS', 2 * 5 * 60))
+
+CELL_FIELDS = ['track_id', 'x', 'y', 'lat', 'lon', 'pixels', 'area_km2', 'max_dbz',
+               'row0', 'row1', 'col0', 'col1', 'speed_kmh', 'heading']
+
+def empty_cells():
+    return {field: np.array([]) for field in CELL_FIELDS}
+
+def coordinate_scale(units):
+    '''Returns kilometers per projected coordinate unit'''
+    return {'km': 1.0, 'kilometer': 1.0, 'kilometers': 1.0}.get(units, 0.001)
+
+def identify_cells(values, x, y, threshold, units='m', crs=None, min_pixels=MIN_CELL_PIXELS):
+    '''Labels contiguous areas at or above the threshold and returns their properties'''
+    labels, count = ndimage.label(np.nan_to_num(values, nan=-np.inf) >= threshold, structure=np.ones((3, 3)))
+
+    if count == 0:
+        return empty_cells()
+
+    flat = labels.ravel()
+    rows, cols = np.indices(values.shape)
+    pixels = np.bincount(flat, minlength=count + 1)[1:]
+    row_mean = np.bincount(flat, weights=rows.ravel(), minlength=count + 1)[1:] / pixels
+    col_mean = np.bincount(flat, weights=cols.ravel(), minlength=count + 1)[1:] / pixels
+    max_dbz = ndimage.maximum(values, labels, np.arange(1, count + 1))
+    bounds = np.array([(s[0].start, s[0].stop, s[1].start, s[1].stop) for s in ndimage.find_objects(labels)])
+
+    keep = pixels >= min_pixels
+    if not keep.any():
+        return empty_cells()
+
+    scale = coordinate_scale(units)
+    pixel_km2 = abs(np.diff(x).mean() * np.diff(y).mean()) * scale ** 2
+    cell_x = np.interp(col_mean[keep], np.arange(len(x)), x)
+    cell_y = np.interp(row_mean[keep], np.arange(len(y)), y)
+
+    if crs is not None:
+        import cartopy.crs as ccrs
+        lonlat = ccrs.PlateCarree().transform_points(crs, cell_x, cell_y)
+        lon, lat = lonlat[:, 0], lonlat[:, 1]
+    else:
+        lon = lat = np.full(keep.sum(), np.nan)
+
+    return {
+        'track_id': np.full(keep.sum(), -1),
+        'x': cell_x,
+        'y': cell_y,
+        'lat': lat,
+        'lon': lon,
+        'pixels': pixels[keep],
+        'area_km2': pixels[keep] * pixel_km2,
+        'max_dbz': np.asarray(max_dbz)[keep],
+        'row0': bounds[keep, 0],
+        'row1': bounds[keep, 1],
+        'col0': bounds[keep, 2],
+        'col1': bounds[keep, 3],
+        'speed_kmh': np.full(keep.sum(), np.nan),
+        'heading': np.full(keep.sum(), np.nan)
+    }
+
+def track_cells(previous, current, elapsed_seconds, units='m', max_distance_km=MAX_MATCH_DISTANCE_KM):
+    '''
+    Matches current cells to the previous scan's cells (closest pairs first,
+    each cell used once), carries over their track ids and fills in speed
+    (km/h) and heading (degrees, 0 = grid north). Unmatched cells get new ids.
+    '''
+    scale = coordinate_scale(units)
+    count = len(current['x'])
+    next_id = int(previous['track_id'].max()) + 1 if len(previous['track_id']) else 0
+
+    if count and len(previous['x']) and elapsed_seconds > 0:
+        dx = (current['x'][None, :] - previous['x'][:, None]) * scale
+        dy = (current['y'][None, :] - previous['y'][:, None]) * scale
+        distance = np.hypot(dx, dy)
+
+        matched_previous, matched_current = set(), set()
+        for flat in np.argsort(distance, axis=None):
+            prev_idx, cur_idx = np.unravel_index(flat, distance.shape)
+            if distance[prev_idx, cur_idx] > max_distance_km:
+                break
+            if prev_idx in matched_previous or cur_idx in matched_current:
+                continue
+            matched_previous.add(prev_idx)
+            matched_current.add(cur_idx)
+
+            current['track_id'][cur_idx] = previous['track_id'][prev_idx]
+            current['speed_kmh'][cur_idx] = distance[prev_idx, cur_idx] / elapsed_seconds * 3600
+            current['heading'][cur_idx] = np.degrees(np.arctan2(dx[prev_idx, cur_idx], dy[prev_idx, cur_idx])) % 360
+
+    new = current['track_id'] < 0
+    current['track_id'][new] = np.arange(next_id, next_id + new.sum())
+    return current
+
+def cells_in_windows(cells, windows):
+    '''Returns an (areas, cells) boolean array of cells whose bounding box overlaps each area window'''
+    row0, row1, col0, col1 = [windows[:, idx][:, None] for idx in range(4)]
+    return ((cells['row0'][None, :] < row1) & (cells['row1'][None, :] > row0) &
+            (cells['col0'][None, :] < col1) & (cells['col1'][None, :] > col0))
+
+def cells_path():
+    return os.path.join(RADAR_CACHE_DIR, 'cells.npz')
+
+def load_previous_cells():
+    '''Returns (scan time, cells) saved by the previous scan, or (None, empty cells)'''
+    try:
+        with np.load(cells_path()) as cached:
+            return cached['time'][()], {field: cached[field] for field in CELL_FIELDS}
+    except (OSError, KeyError):
+        return None, empty_cells()
+
+def save_cells(time, cells):
+    os.makedirs(RADAR_CACHE_DIR, exist_ok=True)
+    temp_path = f'{cells_path()}.{os.getpid()}.tmp.npz'
+    np.savez(temp_path, time=np.datetime64(time), **cells)
+    os.replace(temp_path, cells_path())
+
+def process_scan_cells(scan, time, threshold, crs=None):
+    '''Identifies the scan's cells, tracks them from the previous scan and saves them'''
+    cells = identify_cells(scan['values'], scan['x'], scan['y'], threshold, scan.get('units', 'm'), crs)
+    previous_time, previous = load_previous_cells()
+
+    elapsed = (np.datetime64(time) - previous_time) / np.timedelta64(1, 's') if previous_time is not None else 0
+    if elapsed > MAX_TRACK_GAP_SECONDS:
+        print(f'Previous cells are {elapsed:.0f}s old, starting new tracks')
+        elapsed = 0
+    cells = track_cells(previous, cells, elapsed, scan.get('units', 'm'))
+    save_cells(time, cells)
+    return cells
@@ -0,0 +1,225 @@
+'''
+Disk-backed cache for the GoogleTiles basemap used by create_map
+
+Tiles are stored as tile_cache/<z>/<x>/<y>.png. A tile's modification time is
+when it was downloaded (used for the TTL) and its access time is when it was
+last drawn (used for LRU eviction once the cache grows past its size limit).
+Expired tiles are still served if the network is unavailable, so a warm cache
+renders with no network access at all. Renders share one instance per
+process (shared_tiles), so the cache size is only totalled once.
+
+Usage: python tile_cache.py prefetch [--accounts florida_storms ...] [--zoom 8]
+'''
+import argparse
+import io
+import math
+import os
+import threading
+import time
+
+import numpy as np
+import requests
+from PIL import Image
+from cartopy.io.img_tiles import GoogleTiles
+
+import http_client
+
+TILE_CACHE_DIR = os.environ.get('TILE_CACHE_DIR', 'tile_cache')
+TILE_CACHE_MAX_MB = float(os.environ.get('TILE_CACHE_MAX_MB', 256))
+TILE_CACHE_TTL_DAYS = float(os.environ.get('TILE_CACHE_TTL_DAYS', 30))
+TILE_CACHE_OFFLINE = os.environ.get('TILE_CACHE_OFFLINE', '') == '1'
+
+# Optional tile server URL with {x}, {y} and {z} placeholders (e.g. a local
+# stand-in for the benchmarks); GoogleTiles' own URL is used when unset
+TILE_URL = os.environ.get('TILE_URL')
+
+shared = {}
+
+class CachedGoogleTiles(GoogleTiles):
+    '''GoogleTiles that reads from and writes to a size-bounded on-disk LRU cache'''
+
+    def __init__(self, cache_dir=TILE_CACHE_DIR, max_mb=TILE_CACHE_MAX_MB,
+                 ttl_days=TILE_CACHE_TTL_DAYS, offline=TILE_CACHE_OFFLINE, **kwargs):
+        super().__init__(**kwargs)
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.ttl_seconds = ttl_days * 24 * 60 * 60
+        self.offline = offline
+        self.cache_bytes = None
+        # cartopy fetches a map's tiles from a thread pool
+        self.cache_lock = threading.Lock()
+
+    def tile_path(self, tile):
+        x, y, z = tile
+        return os.path.join(self.cache_dir, str(z), str(x), f'{y}.png')
+
+    def _image_url(self, tile):
+        if TILE_URL:
+            x, y, z = tile
+            return TILE_URL.format(x=x, y=y, z=z)
+        return super()._image_url(tile)
+
+    def download_tile(self, tile):
+        response = http_client.get(self._image_url(tile))
+
+        if response.status_code != 200:
+            raise requests.HTTPError(f'Error accessing {response.url}. Status code: {response.status_code}')
+
+        return response.content
+
+    def cached_files(self):
+        '''Yields (path, atime, size) of finished tiles, skipping other processes' temporary files'''
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if not name.endswith('.png'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    # Evicted by another process
+                    continue
+                yield path, stat.st_atime, stat.st_size
+
+    def evict(self):
+        '''Removes the least recently drawn tiles until the cache fits in max_bytes'''
+        if self.cache_bytes is None:
+            self.cache_bytes = sum(size for _, _, size in self.cached_files())
+
+        if self.cache_bytes <= self.max_bytes:
+            return
+
+        for path, _, size in sorted(self.cached_files(), key=lambda item: item[1]):
+            if self.cache_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.cache_bytes -= size
+
+    def store_tile(self, tile, data):
+        path = self.tile_path(tile)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write then rename so concurrent renders never read a partial tile
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+        with self.cache_lock:
+            if self.cache_bytes is not None:
+                self.cache_bytes += len(data)
+            self.evict()
+
+    def read_tile(self, path, downloaded=None):
+        '''Returns a cached tile, marking it as drawn if its download time is given, or None if it was evicted'''
+        try:
+            if downloaded is not None:
+                os.utime(path, (time.time(), downloaded))
+            with open(path, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def tile_data(self, tile):
+        '''Returns the encoded tile, from the cache when possible, or None if unavailable'''
+        path = self.tile_path(tile)
+        try:
+            downloaded = os.path.getmtime(path)
+        except FileNotFoundError:
+            downloaded = None
+
+        if downloaded is not None and (self.offline or time.time() - downloaded < self.ttl_seconds):
+            data = self.read_tile(path, downloaded)
+            if data is not None:
+                return data
+
+        if not self.offline:
+            try:
+                data = self.download_tile(tile)
+            except requests.RequestException as e:
+                print(f'Unable to download tile {tile}: {e}')
+            else:
+                self.store_tile(tile, data)
+                return data
+
+        # Serve an expired tile rather than none
+        return self.read_tile(path) if downloaded is not None else None
+
+    def get_image(self, tile):
+        data = self.tile_data(tile)
+
+        if data is None:
+            img = Image.fromarray(np.full((256, 256, 3), (250, 250, 250), dtype=np.uint8))
+        else:
+            img = Image.open(io.BytesIO(data))
+
+        img = img.convert(self.desired_tile_form)
+        return img, self.tileextent(tile), 'lower'
+
+def shared_tiles():
+    '''Returns the process-wide CachedGoogleTiles, creating it on first use'''
+    if 'tiles' not in shared:
+        shared['tiles'] = CachedGoogleTiles()
+    return shared['tiles']
+
+def tiles_covering(west, south, east, north, zoom):
+    '''Returns the (x, y, z) web mercator tiles covering a lat/lon bounding box'''
+    n = 2 ** zoom
+
+    def tile_x(lon):
+        return min(n - 1, max(0, int((lon + 180) / 360 * n)))
+
+    def tile_y(lat):
+        lat = math.radians(max(-85.0511, min(85.0511, lat)))
+        return min(n - 1, max(0, int((1 - math.asinh(math.tan(lat)) / math.pi) / 2 * n)))
+
+    return [(x, y, zoom)
+            for x in range(tile_x(west), tile_x(east) + 1)
+            for y in range(tile_y(north), tile_y(south) + 1)]
+
+def prefetch_bounds(west, south, east, north):
+    '''
+    Returns the (west, south, east, north) box any alert map within the bounds
+    can show. Like draw_map, the bounds get the map margins and are rounded
+    out to the basemap grid. The axes then widen the shorter side to the
+    figure's aspect ratio around the alert, which for an alert spanning the
+    full height (or width) reaches up to half the widened size past each edge.
+    '''
+    from basemap import FIGSIZE, quantize_extent
+    from auto_polygon import map_extent
+
+    west, east, south, north = quantize_extent(map_extent(
+        {'west_bound': west, 'east_bound': east, 'south_bound': south, 'north_bound': north}))
+    aspect = FIGSIZE[1] / FIGSIZE[0]
+    x_margin = (north - south) / aspect / 2
+    y_margin = (east - west) * aspect / 2
+    return west - x_margin, south - y_margin, east + x_margin, north + y_margin
+
+def prefetch(states, zoom=8, tiles=None):
+    '''Warms the cache with every tile any alert map within the given states can draw'''
+    from geometry_cache import state_bounds
+
+    tiles = tiles or CachedGoogleTiles(offline=False)
+    fetched = 0
+
+    covered = set()
+    for state in states:
+        for tile in tiles_covering(*prefetch_bounds(*state_bounds(state)), zoom):
+            if tile not in covered:
+                covered.add(tile)
+                fetched += tiles.tile_data(tile) is not None
+
+    print(f'Tile cache warmed with {fetched} tiles for {", ".join(states)} at zoom {zoom}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['prefetch'])
+    parser.add_argument('--accounts', nargs='+', help='Accounts to prefetch (defaults to all of them)')
+    parser.add_argument('--zoom', type=int, default=8)
+    args = parser.parse_args()
+
+    from geometry_cache import account_states
+    prefetch(account_states(args.accounts), args.zoom)